@@ -1,12 +1,20 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routes import debug, ai
 from dotenv import load_dotenv
 import os
 
-# Load environment variables
+# Load environment variables before the routes read their configuration
 load_dotenv()
 
+from routes import debug, ai
+
+# Web search needs chromadb, the rest of the API runs without it
+try:
+    from routes import websearch
+except ImportError as e:
+    websearch = None
+    print(f"Web search disabled, install chromadb to enable it ({e})")
+
 app = FastAPI()
 
 # Add CORS middleware
@@ -21,6 +29,8 @@ app.add_middleware(
 # Include routers
 app.include_router(debug.router)
 app.include_router(ai.router)
+if websearch is not None:
+    app.include_router(websearch.router)
 
 if __name__ == "__main__":
     import uvicorn
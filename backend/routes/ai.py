@@ -1,20 +1,55 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Response
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from enum import Enum
-from singletons.data import data
+from singletons.data import data, get_initial_data, snapshot_history, retire_history, INTERACTION_TTL
+from singletons.jobs import get_job, save_job, job_key, MAX_QUEUED_JOBS, JOB_TTL, LEARN_LEASE_KEY, LEARN_LEASE_TTL
+from singletons.limiter import limiters
+from singletons.models import stage_chat
+from singletons.feedback_stats import record_feedback, record_learn_score, feedback_statistics, learn_trigger, record_auto_learn
+from singletons.memory import register_structure
+from singletons.admission import gates
+from singletons.cancellation import cancel_on_disconnect, record_disconnect, stats as cancellation_stats
+from singletons.uploads import UPLOAD_SPOOL_THRESHOLD, parse_upload_form, form_file
+from singletons.persona import PersonaError, MAX_EDITS, template_summary, apply_edits, persona_history, persona_version, record_persona_version, rollback_persona
+from singletons.documents import DocumentError, ingest_pdf, get_document, page_text, render_page, page_material, resolve_material
 import openai
 import os
 import io
-import requests
 import base64
-from typing import List
+from typing import List, Optional
 import textwrap
 import aiohttp
 import json
 import datetime
+import asyncio
+import uuid
+import hashlib
+import shutil
+import time
+import tempfile
+import re
 
 router = APIRouter()
 
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 25 * 1024 * 1024))  # Groq rejects larger files anyway
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_DOCUMENT_SIZE = int(os.getenv("MAX_DOCUMENT_SIZE", 50 * 1024 * 1024))
+MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", 20 * 1024 * 1024))  # OpenAI rejects larger images
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", 20))
+MULTIMODAL_BATCH_CONCURRENCY = int(os.getenv("MULTIMODAL_BATCH_CONCURRENCY", 4))  # Items of one batch answered at once
+AUDIO_PREPROCESSING = os.getenv("AUDIO_PREPROCESSING", "1") == "1"  # Needs ffmpeg on PATH
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+MAX_CACHED_PERSONAS = 20  # Oldest cached personas are dropped beyond this
+persona_cache = {}  # hash of initial_data and template -> generated persona
+persona_requests = {}  # hash of initial_data and template -> in-flight generation task
+register_structure("persona_cache", lambda: {
+    "entries": len(persona_cache),
+    "max_entries": MAX_CACHED_PERSONAS,
+    "bytes": sum(len(persona.encode()) for persona in persona_cache.values())
+})
+
 class Role(str, Enum):
     TEACHER = "teacher"
     PARENT = "parent"
@@ -29,7 +64,14 @@ class InitialDataRequest(BaseModel):
     
 class MultiModal(BaseModel):
     prompt: str
-    image_base64: str
+    image_base64: Optional[str] = None  # Either a screenshot of the material...
+    doc_id: Optional[str] = None  # ...or a page of a document uploaded to /ai/documents
+    page: int = 1
+
+class MultiModalBatch(BaseModel):
+    items: List[MultiModal]
+    generate_images: bool = True  # Image generation is rate limited, large batches may want to skip it
+    generate_audio: bool = True
 
 class TextToSpeechRequest(BaseModel):
     text: str
@@ -42,9 +84,7 @@ class ImageGenerationRequest(BaseModel):
     n: int = 1
 
 class FeedbackRequest(BaseModel):
-    request: str
-    material: str
-    output: str
+    interaction_id: str
     feedback: str
 
 class MultiModalResponse(BaseModel):
@@ -60,33 +100,171 @@ async def ai_get():
     return {"status": "ok", "message": "AI endpoint working"}
 
 @router.post("/ai/call-multimodal")
-async def multimodal_call(request: MultiModal):
+async def multimodal_call(request: MultiModal, http_request: Request):
     """
-    Endpoint to call OpenAI API with a prompt and a base64-encoded image.
+    Endpoint to call OpenAI API with a prompt and either a base64-encoded image or an uploaded document page.
     """
     try:
         print("[DEBUG] Starting multimodal_call endpoint")
         print(f"[DEBUG] Received prompt length: {len(request.prompt)}")
-        print(f"[DEBUG] Received image_base64 length: {len(request.image_base64)}")
 
         print("[DEBUG] Initializing OpenAI client...")
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
         print(f"[DEBUG] API key present: {bool(client.api_key)}")
         
         if not client.api_key:
             raise HTTPException(status_code=500, detail="OpenAI API key not configured")
 
+        result = await cancel_on_disconnect(http_request, admitted_answer(client, request, await current_persona()))
+
+        print("[DEBUG] Preparing final response")
+        return {"status": "success", **result}
+
+    except Exception as e:
+        raise multimodal_error(e)
+
+@router.post("/ai/call-multimodal/upload")
+async def multimodal_upload_call(request: Request):
+    """
+    Multipart variant of /ai/call-multimodal that takes the image as raw bytes. Expects a "prompt"
+    field and either a "file" field with the image or "doc_id" and "page" fields.
+    """
+    form = None
+    try:
+        form = await parse_upload_form(request, MAX_IMAGE_SIZE)
+        prompt = form.get("prompt")
+        if not isinstance(prompt, str):
+            raise HTTPException(status_code=400, detail="Missing prompt field")
+
+        if form.get("doc_id"):
+            item = MultiModal(prompt=prompt, doc_id=form.get("doc_id"), page=int(form.get("page") or 1))
+        else:
+            upload = form_file(form)
+            print(f"[DEBUG] Received image file: {upload.filename}, size: {upload.size} bytes")
+            # OpenAI takes images inline as base64, so this is the only encoding step
+            item = MultiModal(prompt=prompt, image_base64=base64.b64encode(await upload.read()).decode('utf-8'))
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"[DEBUG] Upload error: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"File upload failed: {str(e)}")
+    finally:
+        if form is not None:
+            await form.close()
+
+    return await multimodal_call(item, request)
+
+@router.post("/ai/call-multimodal/batch")
+async def multimodal_batch_call(request: MultiModalBatch):
+    """
+    Endpoint to answer several prompts, each about its own image or document page, in one request.
+    Streams one JSON line per item as soon as it completes, tagged with the item's index. A failed
+    item is reported as an error line and does not affect the others.
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="No items to answer")
+    if len(request.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Batch exceeds {MAX_BATCH_ITEMS} items")
+
+    client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    if not client.api_key:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+
+    # Read once so every item is answered for the same persona and shares its prompt prefix
+    student_persona = await current_persona()
+    item_slots = asyncio.Semaphore(MULTIMODAL_BATCH_CONCURRENCY)
+
+    async def answer(index, item):
+        async with item_slots:
+            try:
+                result = await admitted_answer(
+                    client, item, student_persona,
+                    with_image=request.generate_images, with_audio=request.generate_audio
+                )
+                return {"index": index, "status": "success", **result}
+            except Exception as e:
+                error = multimodal_error(e)
+                return {"index": index, "status": "error", "status_code": error.status_code, "detail": error.detail}
+
+    async def stream_results():
+        started = time.monotonic()
+        tasks = [asyncio.create_task(answer(index, item)) for index, item in enumerate(request.items)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished) + "\n"
+        finally:
+            # The client went away, stop answering items nobody will read
+            if not all(task.done() for task in tasks):
+                record_disconnect("/ai/call-multimodal/batch", started)
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+async def admitted_answer(client, request, student_persona, with_image=True, with_audio=True):
+    """
+    Answers once the multimodal admission gate lets the request in, skipping image generation
+    when the gate's queue is deep
+    """
+    async with gates["multimodal"].admit() as degraded:
+        result = await answer_multimodal(
+            client, request, student_persona, with_image=with_image and not degraded, with_audio=with_audio
+        )
+        return {**result, "degraded": degraded}
+
+async def current_persona():
+    print("[DEBUG] Checking if student_persona exists in data...")
+    student_persona = await data.get("student_persona")
+    if not student_persona:
+        print("[DEBUG] Warning: student_persona not found in data")
+        student_persona = "No persona available"
+    return student_persona
+
+def multimodal_error(e):
+    """
+    Maps a failure while answering a multimodal request to the HTTPException reported for it
+    """
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, openai.APIError):
+        print(f"[DEBUG] OpenAI API Error: {str(e)}")
+        return HTTPException(status_code=500, detail=f"OpenAI API Error: {str(e)}")
+    if isinstance(e, ValueError):
+        print(f"[DEBUG] Value Error: {str(e)}")
+        return HTTPException(status_code=400, detail=f"Invalid request format: {str(e)}")
+    print(f"[DEBUG] Unexpected error: {type(e).__name__}: {str(e)}")
+    return HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+
+async def answer_multimodal(client, request, student_persona, with_image=True, with_audio=True):
+    """
+    Answers one prompt about an image or document page for a persona, then illustrates and narrates
+    the answer and records the interaction. Returns the fields of the /ai/call-multimodal response.
+    """
+    if not request.image_base64 and not request.doc_id:
+        raise HTTPException(status_code=400, detail="Either image_base64 or doc_id is required")
+
+    page_context = ""
+    if request.doc_id:
+        print(f"[DEBUG] Rendering page {request.page} of document {request.doc_id}...")
+        try:
+            page_image = await asyncio.to_thread(render_page, request.doc_id, request.page)
+            text = await asyncio.to_thread(page_text, request.doc_id, request.page)
+        except DocumentError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        base64_image = base64.b64encode(page_image).decode('utf-8')
+        material = page_material(request.doc_id, request.page)
+        if text.strip():
+            page_context = f"\n        THE PAGE TEXT: {text}"
+    else:
         print("[DEBUG] Cleaning base64 string...")
         base64_image = request.image_base64.split(',')[1] if ',' in request.image_base64 else request.image_base64
-        print(f"[DEBUG] Cleaned base64 length: {len(base64_image)}")
+        material = f"data:image/jpeg;base64,{base64_image}"
+    print(f"[DEBUG] Image base64 length: {len(base64_image)}")
 
-        print("[DEBUG] Checking if student_persona exists in data...")
-        if 'student_persona' not in data:
-            print("[DEBUG] Warning: student_persona not found in data")
-            data['student_persona'] = "No persona available"
-
-        print("[DEBUG] Constructing prompt...")
-        prompt = f'''Analyze the provided image and user query to create a personalized educational response.
+    print("[DEBUG] Constructing prompt...")
+    # The persona comes before the query so requests for the same persona share a cacheable prefix
+    prompt = f'''Analyze the provided image and user query to create a personalized educational response.
         Generate a response following this exact JSON schema:
         {{
             "chat_response": "A detailed, personalized answer to the user's query that matches their learning style and needs",
@@ -94,60 +272,63 @@ async def multimodal_call(request: MultiModal):
             "summary_script": "A concise, natural-sounding script suitable for text-to-speech conversion that summarizes the key points"
         }}
 
-        THE USER QUERY: {request.prompt}
-        THE USER PERSONA: {data['student_persona']}'''
-        
-        print(f"Prompt: {prompt}...")
+        THE USER PERSONA: {student_persona}
+        THE USER QUERY: {request.prompt}{page_context}'''
+    
+    print(f"Prompt: {prompt}...")
 
-        print("[DEBUG] Making OpenAI API call...")
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
+    print("[DEBUG] Making OpenAI API call...")
+    try:
+        response = await stage_chat(
+            client,
+            "answer",
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/jpeg;base64,{base64_image}"
                             }
-                        ]
-                    }
-                ],
-                max_tokens=300,
-                response_format={"type": "json_object"}
-            )
-            print("[DEBUG] OpenAI API call successful")
-        except Exception as e:
-            print(f"[DEBUG] OpenAI API call failed: {str(e)}")
-            raise
+                        }
+                    ]
+                }
+            ],
+            response_format={"type": "json_object"}
+        )
+        print("[DEBUG] OpenAI API call successful")
+    except Exception as e:
+        print(f"[DEBUG] OpenAI API call failed: {str(e)}")
+        raise
 
-        print("[DEBUG] Parsing response...")
-        try:
-            result = MultiModalResponse.parse_raw(response.choices[0].message.content)
-            print("[DEBUG] Response parsed successfully")
-        except Exception as e:
-            print(f"[DEBUG] Failed to parse response: {str(e)}")
-            print(f"[DEBUG] Raw response content: {response.choices[0].message.content}")
-            raise
+    print("[DEBUG] Parsing response...")
+    try:
+        result = MultiModalResponse.parse_raw(response.choices[0].message.content)
+        print("[DEBUG] Response parsed successfully")
+    except Exception as e:
+        print(f"[DEBUG] Failed to parse response: {str(e)}")
+        print(f"[DEBUG] Raw response content: {response.choices[0].message.content}")
+        raise
 
+    image_base64 = None
+    response_text = result.chat_response
+    if with_image:
         print("[DEBUG] Generating image...")
-        image_base64 = None
         try:
             response = await generate_image(result.image_prompt)
             print("[DEBUG] Image generation completed")
             if isinstance(response, Response):
                 image_base64 = base64.b64encode(response.body).decode('utf-8')
-                result.chat_response += f"\n\n![Generated Image](data:image/png;base64,{image_base64})"
+                response_text += f"\n\n![Generated Image](data:image/png;base64,{image_base64})"
                 print("[DEBUG] Image added to response")
         except Exception as e:
             print(f"[DEBUG] Image generation failed: {str(e)}")
 
+    audio_base64 = None
+    if with_audio:
         print("[DEBUG] Generating audio...")
-        audio_base64 = None
         try:
             audio_request = TextToSpeechRequest(text=result.summary_script)
             audio_response = await generate_audio(audio_request)
@@ -156,44 +337,55 @@ async def multimodal_call(request: MultiModal):
         except Exception as e:
             print(f"[DEBUG] Audio generation failed: {str(e)}")
 
-        print("[DEBUG] Preparing final response")
-        return {
-            "status": "success",
-            "response": result.chat_response,
-            "image_base64": image_base64,
-            "audio_base64": audio_base64
-        }
+    print("[DEBUG] Recording interaction for feedback...")
+    # Only the answer text is learned from, the generated image would bloat every history entry and prompt
+    interaction_id = await record_interaction(request.prompt, material, result.chat_response)
 
-    except openai.APIError as e:
-        print(f"[DEBUG] OpenAI API Error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"OpenAI API Error: {str(e)}")
-    except ValueError as e:
-        print(f"[DEBUG] Value Error: {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Invalid request format: {str(e)}")
-    except Exception as e:
-        print(f"[DEBUG] Unexpected error: {type(e).__name__}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+    return {
+        "interaction_id": interaction_id,
+        "response": response_text,
+        "image_base64": image_base64,
+        "audio_base64": audio_base64
+    }
+
+FEEDBACK_GIVEN = {"feedback_given": True}  # Replaces an interaction once its feedback is in history
+INLINE_IMAGE = re.compile(r"\s*!\[[^\]]*\]\(data:image/[^)]*\)")  # Markdown image embedded as a data URL
+
+async def record_interaction(request, material, output):
+    """
+    Stores an interaction server-side and returns the id feedback should reference
+    """
+    interaction_id = uuid.uuid4().hex
+    # Interactions nobody gives feedback on expire
+    await data.set(f"interaction:{interaction_id}", {
+        "request": request,
+        "material": material,
+        "output": output
+    }, ttl=INTERACTION_TTL)
+
+    return interaction_id
 
 @router.post("/ai/call-llm")
-async def call_llm(request: PromptRequest):
+async def call_llm(request: PromptRequest, http_request: Request):
     """
     Endpoint to call OpenAI API with a prompt
     """
     try:
         print("Setting OpenAI API key...")
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
         print("Client initialized")
         
         if not client.api_key:
             raise HTTPException(status_code=500, detail="OpenAI API key not configured")
 
         print(f"Making API call with prompt: {request.prompt[:50]}...")
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        response = await cancel_on_disconnect(http_request, stage_chat(
+            client,
+            "call_llm",
             messages=[
                 {"role": "user", "content": request.prompt}
             ]
-        )
+        ))
         print("API call successful")
 
         response_text = response.choices[0].message.content
@@ -204,6 +396,8 @@ async def call_llm(request: PromptRequest):
             "response": response_text
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error occurred: {type(e).__name__}")
         print(f"Error details: {str(e)}")
@@ -211,68 +405,242 @@ async def call_llm(request: PromptRequest):
 
 
 @router.post("/ai/transcribe")
-async def transcribe_audio(file: UploadFile = File(...)):
+async def transcribe_audio(request: Request):
     """
-    Endpoint to transcribe audio using Groq API
+    Endpoint to transcribe audio using Groq API. Expects a multipart form with a "file" field.
     """
+    form = None
     try:
-        buffer_data = await file.read()
-        print(f"Received audio file: {file.filename}, size: {len(buffer_data)} bytes")
+        form = await parse_upload_form(request, MAX_UPLOAD_SIZE)
+        upload = form_file(form)
+        print(f"Received audio file: {upload.filename}, size: {upload.size} bytes")
         
         groq_api_key = os.getenv("GROQ_API_KEY")
         if not groq_api_key:
             raise HTTPException(status_code=500, detail="Groq API key not configured")
 
         try:
-            transcribed_text = groq_transcribe(buffer_data, groq_api_key)
+            audio_file, filename, content_type, audio_stats = await cancel_on_disconnect(
+                request, preprocess_audio(upload.file, upload.filename, upload.content_type)
+            )
+            transcribed_text = await cancel_on_disconnect(request, limiters["groq"].call(
+                groq_transcribe, audio_file, groq_api_key, filename, content_type
+            ))
             print(f"Transcription result: {transcribed_text}")
 
             return {
                 "status": "success",
-                "transcription": transcribed_text
+                "transcription": transcribed_text,
+                "audio_preprocessing": audio_stats
             }
 
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"Transcription error: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Upload error: {str(e)}")
         raise HTTPException(status_code=400, detail=f"File upload failed: {str(e)}")
+    finally:
+        if form is not None:
+            await form.close()
 
-@router.post("/ai/set-initial-data")
-async def set_initial_data(request: InitialDataRequest):
+@router.post("/ai/documents")
+async def upload_document(request: Request):
     """
-    Endpoint to set initial data for a specific role using audio input
+    Endpoint to upload a PDF once and reference its pages by doc_id in /ai/call-multimodal.
+    Expects a multipart form with a "file" field.
     """
+    form = None
     try:
-        if "initial_data" not in data:
-            data["initial_data"] = {}
-
-        # Decode base64 string to bytes
-        audio_bytes = base64.b64decode(request.audio)
-        
-        groq_api_key = os.getenv("GROQ_API_KEY")
-        if not groq_api_key:
-            raise HTTPException(status_code=500, detail="Groq API key not configured")
+        form = await parse_upload_form(request, MAX_DOCUMENT_SIZE)
+        upload = form_file(form)
+        print(f"Received document: {upload.filename}, size: {upload.size} bytes")
 
-        # Convert bytes to transcribed text
-        transcribed_text = groq_transcribe(audio_bytes, groq_api_key)
-        
-        data["initial_data"][request.role.value] = transcribed_text
+        try:
+            document = await asyncio.to_thread(ingest_pdf, upload.file, uuid.uuid4().hex, upload.filename)
+        except DocumentError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
-        print(data)
-        
         return {
             "status": "success",
-            "role": request.role,
-            "transcribed_text": transcribed_text
+            "doc_id": document["id"],
+            "pages": document["pages"]
         }
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Document upload error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Document upload failed: {str(e)}")
+    finally:
+        if form is not None:
+            await form.close()
+
+@router.get("/ai/documents/{doc_id}")
+async def document_info(doc_id: str):
+    """
+    Endpoint to get the page count and extracted text of an uploaded document
+    """
+    try:
+        document = await asyncio.to_thread(get_document, doc_id)
+    except DocumentError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {
+        "doc_id": document["id"],
+        "filename": document["filename"],
+        "pages": document["pages"],
+        "texts": document["texts"]
+    }
+
+@router.get("/ai/documents/{doc_id}/pages/{page}")
+async def document_page(doc_id: str, page: int):
+    """
+    Endpoint to get a page of an uploaded document as the JPEG sent to the model
+    """
+    try:
+        image = await asyncio.to_thread(render_page, doc_id, page)
+    except DocumentError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return Response(content=image, media_type="image/jpeg")
+
+@router.post("/ai/set-initial-data")
+async def set_initial_data(request: InitialDataRequest, http_request: Request):
+    """
+    Endpoint to set initial data for a specific role using audio input
+    """
+    try:
+        # Decode base64 string to bytes
+        audio_bytes = base64.b64decode(request.audio)
+        return await cancel_on_disconnect(http_request, store_initial_data(request.role, io.BytesIO(audio_bytes)))
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in set_initial_data: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/ai/set-initial-data/upload")
+async def set_initial_data_upload(request: Request):
+    """
+    Multipart variant of /ai/set-initial-data that takes the audio as raw bytes.
+    Expects a "role" field and a "file" field.
+    """
+    form = None
+    try:
+        form = await parse_upload_form(request, MAX_UPLOAD_SIZE)
+        try:
+            role = Role(form.get("role"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid role: {form.get('role')}")
+        upload = form_file(form)
+        print(f"Received audio file for {role.value}: {upload.filename}, size: {upload.size} bytes")
+
+        return await cancel_on_disconnect(
+            request, store_initial_data(role, upload.file, upload.filename, upload.content_type)
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error in set_initial_data_upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if form is not None:
+            await form.close()
+
+async def store_initial_data(role, audio_file, filename=None, content_type=None):
+    """
+    Transcribes a role's audio and stores the transcript as that role's initial data
+    """
+    groq_api_key = os.getenv("GROQ_API_KEY")
+    if not groq_api_key:
+        raise HTTPException(status_code=500, detail="Groq API key not configured")
+
+    # Shrink the audio, then convert it to transcribed text
+    audio_file, filename, content_type, audio_stats = await preprocess_audio(audio_file, filename, content_type)
+    transcribed_text = await limiters["groq"].call(
+        groq_transcribe, audio_file, groq_api_key, filename, content_type
+    )
     
+    await data.set(f"initial_data:{role.value}", transcribed_text)
+
+    print(f"Stored initial data for {role.value}")
+    
+    return {
+        "status": "success",
+        "role": role,
+        "transcribed_text": transcribed_text,
+        "audio_preprocessing": audio_stats
+    }
+    
+def persona_cache_key(initial_data, persona_template):
+    """
+    Hashes the three transcripts together with the template, so editing the template invalidates the cache
+    """
+    digest = hashlib.sha256()
+    for part in (initial_data["teacher"], initial_data["parent"], initial_data["student"], persona_template):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+async def generate_persona(initial_data, persona_template, cache_key):
+    """
+    Fills the persona template from the initial data with GPT-4o and caches the result
+    """
+    print("Setting OpenAI API key...")
+    client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    print("Client initialized")
+    
+    if not client.api_key:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+
+    base_prompt = f"""
+    You are an expert people persona creator. You can create a custom user persona based on the data provided for a student.
+    The below data gives the details of a student in the perspective of his teacher, parent and the student himself.
+    The information about the student are as follows with respect to different roles:
+    
+    INFORMATION FROM STUDENT HIMSELF:
+    {initial_data["student"]}
+    
+    INFORMATION OF STUDENT FROM PARENT:
+    {initial_data["parent"]}
+    
+    INFORMATION OF STUDENT FROM TEACHER:
+    {initial_data["teacher"]}
+
+    Please fill in the template with appropriate information based on the following data:
+    The below shows the sample template which you have to follow strictly:
+    {persona_template}
+    
+    Return only the filled XML template without any additional text."""
+
+    print(f"Making API call with prompt...")
+    print(base_prompt)
+
+    response = await stage_chat(
+        client,
+        "persona_creation",
+        messages=[
+            {"role": "user", "content": base_prompt}
+        ]
+    )
+    print("API call successful")
+
+    # Stored in the form apply_edits writes, raising PersonaError if the XML cannot be edited later
+    response_text = apply_edits(response.choices[0].message.content, [])
+    persona_cache[cache_key] = response_text
+
+    # Forget the oldest cached personas
+    while len(persona_cache) > MAX_CACHED_PERSONAS:
+        del persona_cache[next(iter(persona_cache))]
+
+    return response_text
+
 @router.post("/ai/create-user-persona")
 async def create_persona():
     try:
@@ -281,71 +649,102 @@ async def create_persona():
         with open(template_path, 'r') as f:
             persona_template = f.read()
 
-        print("Setting OpenAI API key...")
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        print("Client initialized")
-        
-        if not client.api_key:
-            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-
-        base_prompt = f"""
-        You are an expert people persona creator. You can create a custom user persona based on the data provided for a student.
-        The below data gives the details of a student in the perspective of his teacher, parent and the student himself.
-        The information about the student are as follows with respect to different roles:
-        
-        INFORMATION FROM STUDENT HIMSELF:
-        {data['initial_data']["student"]}
-        
-        INFORMATION OF STUDENT FROM PARENT:
-        {data['initial_data']["parent"]}
-        
-        INFORMATION OF STUDENT FROM TEACHER:
-        {data['initial_data']["teacher"]}
+        initial_data = await get_initial_data()
+        cache_key = persona_cache_key(initial_data, persona_template)
+        cached = cache_key in persona_cache
+
+        if cached:
+            print("Persona cache hit")
+            response_text = persona_cache[cache_key]
+        else:
+            # Identical concurrent requests share a single generation
+            task = persona_requests.get(cache_key)
+            if task is None:
+                task = asyncio.create_task(generate_persona(initial_data, persona_template, cache_key))
+                persona_requests[cache_key] = task
+                task.add_done_callback(lambda _: persona_requests.pop(cache_key, None))
+            else:
+                print("Joining in-flight persona generation")
+
+            # Shielded so one caller disconnecting does not cancel the others
+            response_text = await asyncio.shield(task)
 
-        Please fill in the template with appropriate information based on the following data:
-        The below shows the sample template which you have to follow strictly:
-        {persona_template}
-        
-        Return only the filled XML template without any additional text."""
-
-        print(f"Making API call with prompt...")
-        print(base_prompt)
-
-        response = client.chat.completions.create(
-            model="gpt-4o",  
-            messages=[
-                {"role": "user", "content": base_prompt}
-            ]
-        )
-        print("API call successful")
-
-        response_text = response.choices[0].message.content
         print(f"Got response text: {response_text}...")
-        data["student_persona"] = response_text
-        print(data)
-
+        # A cache hit usually returns the current persona, which needs no new version
+        while True:
+            current = await data.get("student_persona")
+            if current == response_text:
+                print("Persona unchanged, no new version recorded")
+                break
+            if await data.compare_and_set("student_persona", current, response_text):
+                await record_persona_version(response_text, "created")
+                break
 
         return {
             "status": "success",
-            "response": response_text
+            "response": response_text,
+            "cached": cached
         }
 
     except FileNotFoundError:
         print("Persona template file not found")
         raise HTTPException(status_code=500, detail="Persona template file not found")
+    except PersonaError as e:
+        print(f"Generated persona is invalid: {str(e)}")
+        raise HTTPException(status_code=502, detail=f"Generated persona is invalid, try again: {str(e)}")
     except Exception as e:
         print(f"Error occurred: {type(e).__name__}")
         print(f"Error details: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/ai/persona/history")
+async def get_persona_history():
+    """
+    Endpoint to list the stored persona versions, newest first, without their XML
+    """
+    return {
+        "current_version": await data.get("persona_version"),
+        "versions": [
+            {key: value for key, value in entry.items() if key != "persona"}
+            for entry in reversed(await persona_history())
+        ]
+    }
+
+@router.get("/ai/persona/history/{version}")
+async def get_persona_version(version: int):
+    """
+    Endpoint to get a stored persona version with its XML
+    """
+    entry = await persona_version(version)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Persona version {version} is not in the history")
+    return entry
+
+@router.post("/ai/persona/rollback/{version}")
+async def rollback(version: int):
+    """
+    Endpoint to make a stored persona version current again
+    """
+    try:
+        new_version = await rollback_persona(version)
+    except PersonaError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if new_version is None:
+        raise HTTPException(status_code=409, detail="Persona was changed by another request, try again")
+    return {
+        "status": "success",
+        "version": new_version,
+        "restored_version": version
+    }
+
 async def evaluator(student_persona, request, material_image_url, output, feedback):
     """
-    Evaluates an interaction and returns a score and reason using GPT-4V
+    Evaluates an interaction and returns a score and reason using the evaluation model
     
     Args:
         student_persona (str): The student's persona
         request (str): The student's original request
-        material_image_url (str): URL or base64 of the image being worked with
+        material_image_url (str): URL or base64 of the image being worked with, or a document page reference
         output (str): The response given to the student
         feedback (str): The student's feedback on the response
     
@@ -353,7 +752,7 @@ async def evaluator(student_persona, request, material_image_url, output, feedba
         tuple: (score, reason)
     """
     try:
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
         
         prompt = f"""You are an expert evaluator of a student's learning.
         Evaluate the interaction and return ONLY a JSON object with exactly two fields:
@@ -367,33 +766,37 @@ async def evaluator(student_persona, request, material_image_url, output, feedba
 
         DO NOT include any other text besides the JSON object."""
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        content = [
+            {
+                "type": "text",
+                "text": prompt
+            }
+        ]
+        material_url = await asyncio.to_thread(resolve_material, material_image_url)
+        if material_url:  # The material of an expired document is left out
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": material_url
+                }
+            })
+        content.append({
+            "type": "text",
+            "text": f"""STUDENT PERSONA: {student_persona}
+            STUDENT REQUEST: {request}
+            OUTPUT GIVEN: {output}
+            STUDENT FEEDBACK: {feedback}"""
+        })
+
+        response = await stage_chat(
+            client,
+            "evaluation",
             messages=[
                 {
                     "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": material_image_url
-                            }
-                        },
-                        {
-                            "type": "text",
-                            "text": f"""STUDENT PERSONA: {student_persona}
-                            STUDENT REQUEST: {request}
-                            OUTPUT GIVEN: {output}
-                            STUDENT FEEDBACK: {feedback}"""
-                        }
-                    ]
+                    "content": content
                 }
             ],
-            max_tokens=300,
             response_format={ "type": "json_object" }  # Enforce JSON output
         )
 
@@ -404,12 +807,107 @@ async def evaluator(student_persona, request, material_image_url, output, feedba
         print(f"Error in evaluator: {str(e)}")
         return (0, f"Evaluation failed: {str(e)}")
 
-def optimize_prompt(history, student_persona):
+async def batch_evaluator(student_persona, interactions):
     """
-    Function that optimizes the user persona based on interaction history
+    Evaluates several interactions in a single request, sharing the instructions and persona
+    
+    Args:
+        student_persona (str): The student's persona
+        interactions (list): History entries with request, material, output and feedback
+    
+    Returns:
+        list: (score, reason) for each interaction, in order. Items the model did not
+        score correctly are re-scored one at a time with evaluator.
     """
+    results = [None] * len(interactions)
     try:
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+        
+        prompt = f"""You are an expert evaluator of a student's learning.
+        Evaluate each of the {len(interactions)} numbered interactions below independently and return ONLY a JSON object
+        with a single key 'results' holding an array with one object per interaction, each with exactly three fields:
+        - index: the number of the interaction being scored
+        - score: a number between 0 and 100
+        - reason: a brief explanation for the score
+
+        Consider:
+        1. How well the response matched the student's persona
+        2. How accurately the image was interpreted
+        3. How helpful the response was based on the student's feedback
+
+        DO NOT include any other text besides the JSON object.
+
+        STUDENT PERSONA: {student_persona}"""
+
+        content = [{"type": "text", "text": prompt}]
+        for index, interaction in enumerate(interactions):
+            content.append({
+                "type": "text",
+                "text": f"""INTERACTION {index}
+                STUDENT REQUEST: {interaction.get("request")}
+                OUTPUT GIVEN: {interaction.get("output")}
+                STUDENT FEEDBACK: {interaction.get("feedback")}
+                MATERIAL IMAGE:"""
+            })
+            material_url = await asyncio.to_thread(resolve_material, interaction.get("material"))
+            if material_url:
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": material_url
+                    }
+                })
+
+        response = await stage_chat(
+            client,
+            "batch_evaluation",
+            messages=[
+                {
+                    "role": "user",
+                    "content": content
+                }
+            ],
+            max_tokens_scale=len(interactions),
+            response_format={ "type": "json_object" }  # Enforce JSON output
+        )
+
+        for item in json.loads(response.choices[0].message.content).get("results", []):
+            try:
+                index = int(item["index"])
+                score = float(item["score"])
+                if 0 <= index < len(interactions) and 0 <= score <= 100 and results[index] is None:
+                    results[index] = (score, str(item["reason"]))
+            except (KeyError, TypeError, ValueError):
+                continue  # Malformed rows are re-scored individually below
+
+    except Exception as e:
+        print(f"Error in batch_evaluator: {str(e)}")
+
+    missing = [index for index, result in enumerate(results) if result is None]
+    if missing:
+        print(f"Batch evaluation missed {len(missing)} of {len(interactions)} items, scoring them individually")
+        fallback = await asyncio.gather(*(
+            evaluator(
+                student_persona,
+                interactions[index].get("request"),
+                interactions[index].get("material"),
+                interactions[index].get("output"),
+                interactions[index].get("feedback")
+            )
+            for index in missing
+        ))
+        for index, result in zip(missing, fallback):
+            results[index] = result
+
+    return results
+
+async def optimize_prompt(history, student_persona):
+    """
+    Function that proposes edits to the user persona based on interaction history.
+    Returns (persona, edits), the original persona with no edits if optimization fails.
+    """
+    try:
+        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
         
         # Create a filtered version of history without image URLs
         filtered_history = [{
@@ -420,8 +918,8 @@ def optimize_prompt(history, student_persona):
         } for item in history]
         
         prompt = f"""You are an expert in analyzing learning interactions and optimizing student personas.
-        Based on the provided interaction history and current user persona, create an optimized version of the persona
-        that addresses any weaknesses or gaps identified in the learning process.
+        Based on the provided interaction history and current user persona, propose edits to the persona
+        that address any weaknesses or gaps identified in the learning process.
 
         Current User Persona:
         {student_persona}
@@ -435,101 +933,514 @@ def optimize_prompt(history, student_persona):
         3. Common themes in feedback
         4. Score patterns and their reasons
 
-        Return ONLY a JSON object with a single key 'new_student_persona' containing the optimized persona.
-        The new persona should maintain the same XML structure as the original but with optimized content."""
+        Editable persona fields, by path below <Persona>:
+        {template_summary()}
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        Return ONLY a JSON object with a single key 'edits' holding a list of at most {MAX_EDITS} edits, each one of:
+        {{"op": "set", "path": <text field>, "value": <new text>}}
+        {{"op": "set_attribute", "path": <attributes field>, "attribute": <name>, "value": <new value>}}
+        {{"op": "add_item", "path": <items field>, "value": <item text>, "attributes": {{<name>: <value>}}}}
+        {{"op": "remove_item", "path": <items field>, "value": <item text or name attribute>}}
+        Only edit the fields that need to change."""
+
+        response = await stage_chat(
+            client,
+            "persona_optimization",
             messages=[
                 {"role": "user", "content": prompt}
             ],
             response_format={ "type": "json_object" }
         )
 
-        result = json.loads(response.choices[0].message.content)
-        return result["new_student_persona"]
+        edits = json.loads(response.choices[0].message.content)["edits"]
+        return apply_edits(student_persona, edits), edits
 
     except Exception as e:
         print(f"Error in optimize_prompt: {str(e)}")
-        return student_persona  # Return original persona if optimization fails
-
-@router.post("/ai/learn")
-async def learn():
+        return student_persona, []  # Keep the original persona if optimization fails
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+FINISHED_JOB_STATUSES = (JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED)
+
+# Created lazily so they bind to the running event loop
+learn_queue = None
+learn_worker = None
+learn_tasks = {}  # job_id -> asyncio.Task of the job currently running
+evaluation_slots = asyncio.Semaphore(8)  # Bounds concurrent evaluator calls during learning
+EVALUATION_BATCH_SIZE = max(1, int(os.getenv("EVALUATION_BATCH_SIZE", 5)))  # 1 disables batching
+AUTO_LEARN = os.getenv("AUTO_LEARN", "1") == "1"  # Start learning from feedback statistics
+LEARN_ABANDON_TIMEOUT = int(os.getenv("LEARN_ABANDON_TIMEOUT", 120))  # Seconds without status polls before a submitted job is cancelled, 0 never
+
+def ensure_learn_worker():
     """
-    Endpoint to evaluate and optimize the learning process based on history
+    Starts the background learn worker if it is not already running
     """
-    try:
-        if "history" not in data or "student_persona" not in data:
-            raise HTTPException(status_code=400, detail="History or user persona not found in data")
+    global learn_queue, learn_worker
+    if learn_queue is None:
+        learn_queue = asyncio.Queue(maxsize=MAX_QUEUED_JOBS)
+    if learn_worker is None or learn_worker.done():
+        learn_worker = asyncio.create_task(process_learn_jobs())
+
+def finished_job(job, status, error=None):
+    return {
+        **job,
+        "status": status,
+        "error": error,
+        "finished_at": datetime.datetime.now().isoformat()
+    }
 
-        threshold = 60  # Score threshold for success
-        max_iterations = 5  # Maximum number of optimization attempts
+async def finish_job(job, status, error=None):
+    # Finished jobs expire
+    await save_job(finished_job(job, status, error), ttl=JOB_TTL)
 
-        for iteration in range(max_iterations):
-            total_score = 0
-            
-            # Score each interaction in history
-            for interaction in data["history"]:
-                score_data = await evaluator(
-                    data["student_persona"],
+def cancel_key(job_id):
+    return f"learn_job_cancel:{job_id}"
+
+def seen_key(job_id):
+    return f"learn_job_seen:{job_id}"
+
+async def job_abandoned(job):
+    if not job.get("abandon_after"):
+        return False
+    return time.time() - await data.get(seen_key(job["id"]), 0) > job["abandon_after"]
+
+async def acquire_learn_lease(job_id):
+    """
+    Waits until this worker holds the learn lease for job_id. Returns the queued job,
+    or None if it stopped being queued while waiting.
+    """
+    while True:
+        queued = await get_job(job_id)
+        if queued is None or queued["status"] != JobStatus.QUEUED:
+            return None  # Cancelled while waiting in the queue
+        if await data.compare_and_set(LEARN_LEASE_KEY, None, job_id, ttl=LEARN_LEASE_TTL):
+            return queued
+        await asyncio.sleep(1)
+
+async def release_learn_lease(job_id):
+    # Letting it expire within a second keeps the release a single compare_and_set
+    await data.compare_and_set(LEARN_LEASE_KEY, job_id, job_id, ttl=1)
+
+async def watch_for_cancellation(job, task):
+    """
+    Cancels a running job when another worker records a cancellation request for it,
+    or when the client that submitted it stopped polling its status. Renews the
+    learn lease while the job runs.
+    """
+    while not task.done():
+        await asyncio.sleep(1)
+        if not await data.compare_and_set(LEARN_LEASE_KEY, job["id"], job["id"], ttl=LEARN_LEASE_TTL):
+            print(f"Learn job {job['id']} lost its lease, another job may start alongside it")
+        if not await data.get(cancel_key(job["id"])) and await job_abandoned(job):
+            print(f"Learn job {job['id']} has not been polled for {job['abandon_after']}s, cancelling it")
+            cancellation_stats["abandoned_learn_jobs"] += 1
+            await data.set(cancel_key(job["id"]), "Abandoned by client", ttl=JOB_TTL)
+        if await data.get(cancel_key(job["id"])):
+            task.cancel()
+
+async def process_learn_jobs():
+    """
+    Runs queued learn jobs one at a time across every worker, since every job rewrites the same persona
+    """
+    while True:
+        job_id = await learn_queue.get()
+        queued = None
+        try:
+            queued = await acquire_learn_lease(job_id)
+            if queued is None:
+                continue
+            if await job_abandoned(queued):
+                cancellation_stats["abandoned_learn_jobs"] += 1
+                await finish_job(queued, JobStatus.CANCELLED, "Abandoned by client")
+                continue
+
+            job = {
+                **queued,
+                "status": JobStatus.RUNNING,
+                "started_at": datetime.datetime.now().isoformat()
+            }
+            if not await data.compare_and_set(job_key(job_id), queued, job):
+                continue  # Cancelled by another worker just now
+
+            task = asyncio.create_task(run_learn(job))
+            learn_tasks[job_id] = task
+            watcher = asyncio.create_task(watch_for_cancellation(job, task))
+            try:
+                await task
+                await finish_job(job, JobStatus.SUCCEEDED)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise  # The worker itself is being shut down
+                await finish_job(job, JobStatus.CANCELLED, await data.get(cancel_key(job_id)) or "Cancelled by request")
+            except Exception as e:
+                print(f"Error in learn job {job_id}: {str(e)}")
+                await finish_job(job, JobStatus.FAILED, str(e))
+            finally:
+                watcher.cancel()
+                learn_tasks.pop(job_id, None)
+        finally:
+            if queued is not None:
+                await release_learn_lease(job_id)
+            learn_queue.task_done()
+
+async def evaluate_persona(student_persona, history):
+    """
+    Scores every interaction in history against a persona, in concurrent batches
+    """
+    async def evaluate(batch):
+        async with evaluation_slots:
+            if len(batch) == 1:
+                interaction = batch[0]
+                return [await evaluator(
+                    student_persona,
                     interaction.get("request"),
                     interaction.get("material"),
                     interaction.get("output"),
                     interaction.get("feedback")
-                )
-                interaction["score"] = {
-                    "value": score_data[0],  # Numeric score
-                    "reason": score_data[1]  # Reason for the score
-                }
-                total_score += score_data[0]
-            
-            # Calculate average score
-            average_score = total_score / len(data["history"])
-            
-            # If average score is above threshold, we're done
-            if average_score >= threshold:
-                # Clear history before returning
-                data["history"] = []
-                return {
-                    "status": "success",
-                    "message": "Learning optimization complete",
-                    "final_score": average_score
-                }
-            
-            # Otherwise, optimize the user persona
-            data["student_persona"] = optimize_prompt(data["history"], data["student_persona"])
-        
-        # If we reach here, we've hit max iterations without success
+                )]
+            return await batch_evaluator(student_persona, batch)
+
+    batches = [history[i:i + EVALUATION_BATCH_SIZE] for i in range(0, len(history), EVALUATION_BATCH_SIZE)]
+    results = await asyncio.gather(*(evaluate(batch) for batch in batches))
+    return [score_data for batch in results for score_data in batch]
+
+async def run_learn(job):
+    """
+    Evaluates the history and searches for a better persona until the score threshold is met.
+    Each round generates several candidate personas concurrently and keeps the best scoring one.
+    """
+    threshold = 60  # Score threshold for success
+    max_iterations = 5  # Scored iterations, every one but the last followed by an optimization round
+    num_candidates = 3  # Candidate personas generated per round
+
+    # Learning works on a snapshot; feedback stored meanwhile waits for the next run
+    history_version, snapshot = await snapshot_history()
+    if not snapshot:
+        # An earlier job already learned from and retired every entry
+        job["history_entries"] = 0
+        job["message"] = "No new history to learn from"
+        return
+    # Scores are added to copies, the stored history is left untouched
+    history = [dict(interaction) for interaction in snapshot]
+    job["history_entries"] = len(history)
+    student_persona = await data.get("student_persona")
+    try:
+        apply_edits(student_persona, [])
+    except PersonaError as e:
+        # No edit could be applied, so every round would fail to produce candidates
+        raise PersonaError(f"Current persona cannot be edited: {e}")
+    results = await evaluate_persona(student_persona, history)
+
+    for iteration in range(max_iterations):
+        for interaction, score_data in zip(history, results):
+            interaction["score"] = {
+                "value": score_data[0],  # Numeric score
+                "reason": score_data[1]  # Reason for the score
+            }
+        scores = [score_data[0] for score_data in results]
+        average_score = sum(scores) / len(scores)
+        progress = {
+            "iteration": iteration + 1,
+            "average_score": average_score,
+            "scores": scores,
+            "candidate_scores": []
+        }
+        job["iterations"].append(progress)
+        await save_job(job)
+
+        # If average score is above threshold, we're done
+        if average_score >= threshold:
+            # Retire only the entries this run learned from
+            if not await retire_history(history_version, len(history)):
+                print("History was retired by another learn run, keeping it")
+            job["final_score"] = average_score
+            await record_learn_score(average_score)
+            return
+
+        if iteration == max_iterations - 1:
+            break
+
+        # Otherwise, generate candidate personas and score them in parallel
+        candidates = await asyncio.gather(*(
+            optimize_prompt(history, student_persona)
+            for _ in range(num_candidates)
+        ))
+        # optimize_prompt returns the original persona when it fails
+        # apply_edits re-serialises the persona, so compare against the current persona in
+        # the same form to drop candidates whose edits change nothing
+        unchanged = apply_edits(student_persona, [])
+        candidate_edits = {}
+        for candidate, edits in candidates:
+            if edits and candidate not in (student_persona, unchanged):
+                candidate_edits.setdefault(candidate, edits)
+        candidates = list(candidate_edits)
+        candidate_results = await asyncio.gather(*(
+            evaluate_persona(candidate, history) for candidate in candidates
+        ))
+        candidate_scores = [
+            sum(score_data[0] for score_data in result) / len(result)
+            for result in candidate_results
+        ]
+        progress["candidate_scores"] = candidate_scores
+        await save_job(job)
+
+        # Keep the best candidate if it beats the current persona
+        if candidate_scores and max(candidate_scores) > average_score:
+            best = candidate_scores.index(max(candidate_scores))
+            if not await data.compare_and_set("student_persona", student_persona, candidates[best]):
+                raise Exception("Persona was changed by another request while learning")
+            student_persona = candidates[best]
+            progress["persona_version"] = await record_persona_version(
+                student_persona, f"learn:{job['id']}", candidate_edits[student_persona], candidate_scores[best]
+            )
+            await save_job(job)
+            results = candidate_results[best]
+    
+    # If we reach here, we've hit max iterations without success
+    raise Exception(
+        f"Failed to achieve target score after {max_iterations} iterations ({max_iterations - 1} optimization rounds)"
+    )
+
+async def submit_learn_job(abandon_after=None):
+    """
+    Queues a learn job on this worker and returns its id. A job with abandon_after is
+    cancelled once its status has not been polled for that many seconds.
+    """
+    if not await data.list_length("history") or not await data.get("student_persona"):
+        raise HTTPException(status_code=400, detail="History or user persona not found in data")
+
+    ensure_learn_worker()
+    if learn_queue.full():
         raise HTTPException(
-            status_code=400, 
-            detail=f"Failed to achieve target score after {max_iterations} optimization attempts"
+            status_code=503,
+            detail="Too many learn jobs queued, try again later",
+            headers={"Retry-After": "30"}
         )
 
-    except Exception as e:
-        print(f"Error in learn endpoint: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    job_id = uuid.uuid4().hex
+    await save_job({
+        "id": job_id,
+        "status": JobStatus.QUEUED,
+        "created_at": datetime.datetime.now().isoformat(),
+        "started_at": None,
+        "finished_at": None,
+        "history_entries": None,
+        "iterations": [],
+        "final_score": None,
+        "error": None,
+        "message": None,
+        "abandon_after": abandon_after
+    })
+    await data.set(seen_key(job_id), time.time(), ttl=JOB_TTL)
+    learn_queue.put_nowait(job_id)
+    return job_id
+
+@router.post("/ai/learn", status_code=202)
+async def learn():
+    """
+    Endpoint to submit a background job that evaluates and optimizes the persona based on history.
+    The job is cancelled if its status stops being polled for LEARN_ABANDON_TIMEOUT seconds.
+    """
+    return {
+        "status": "accepted",
+        "job_id": await submit_learn_job(abandon_after=LEARN_ABANDON_TIMEOUT or None)
+    }
+
+@router.get("/ai/learn/stats")
+async def learn_stats():
+    """
+    Endpoint to get the rolling feedback and score statistics behind automatic learning
+    """
+    stats = await feedback_statistics()
+    return {**stats, "trigger": await learn_trigger(stats)}
+
+@router.get("/ai/learn/{job_id}")
+async def learn_status(job_id: str):
+    """
+    Endpoint to get the status and per-iteration progress of a learn job
+    """
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Learn job not found")
+    if job["status"] not in FINISHED_JOB_STATUSES:
+        await data.set(seen_key(job_id), time.time(), ttl=JOB_TTL)
+    return {**job, "cancel_requested": bool(await data.get(cancel_key(job_id)))}
+
+@router.post("/ai/learn/{job_id}/cancel")
+async def cancel_learn(job_id: str):
+    """
+    Endpoint to cancel a queued or running learn job
+    """
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Learn job not found")
+    if job["status"] in FINISHED_JOB_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Learn job already {job['status']}")
+
+    # The worker skips jobs that are no longer queued
+    cancelled = job["status"] == JobStatus.QUEUED and await data.compare_and_set(
+        job_key(job_id), job, finished_job(job, JobStatus.CANCELLED, "Cancelled by request"), ttl=JOB_TTL
+    )
+    if not cancelled:
+        # A worker running the job elsewhere polls for this
+        await data.set(cancel_key(job_id), "Cancelled by request", ttl=JOB_TTL)
+        if job_id in learn_tasks:
+            learn_tasks[job_id].cancel()
+
+    return {
+        "status": "success",
+        "message": "Learn job cancellation requested"
+    }
+
+async def read_chunks(audio_file):
+    """
+    Streams a seekable file from the start, so a retried request re-reads the whole file
+    """
+    audio_file.seek(0)
+    while chunk := await asyncio.to_thread(audio_file.read, UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+async def preprocess_audio(audio_file, filename=None, content_type=None):
+    """
+    Downmixes audio to mono 16 kHz, trims silences and encodes it as Opus with ffmpeg before transcription.
+    Falls back to the original audio, named filename, when preprocessing is disabled, ffmpeg is missing or it fails.
+    
+    Returns:
+        tuple: (file, filename, content_type, stats) where stats holds the original and processed sizes
+    """
+    audio_file.seek(0, os.SEEK_END)
+    original_size = audio_file.tell()
+    audio_file.seek(0)
+    stats = {
+        "original_bytes": original_size,
+        "processed_bytes": original_size,
+        "reduction": 0.0
+    }
+    # Groq tells formats apart by file extension
+    if not filename or "." not in filename:
+        filename, content_type = "audio.mp3", "audio/mpeg"
+    content_type = content_type or "application/octet-stream"
+    if not AUDIO_PREPROCESSING or FFMPEG_PATH is None:
+        return audio_file, filename, content_type, stats
+
+    process = None
+    processed = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD)
+
+    def stop_ffmpeg():
+        if process is not None and process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass  # Exited just now
+        processed.close()
+
+    try:
+        # Probing containers such as mp4 needs a seekable input, so ffmpeg reads from a temp file
+        with tempfile.NamedTemporaryFile() as source:
+            await asyncio.to_thread(shutil.copyfileobj, audio_file, source, UPLOAD_CHUNK_SIZE)
+            source.flush()
+
+            process = await asyncio.create_subprocess_exec(
+                FFMPEG_PATH, "-nostdin", "-loglevel", "error",
+                "-i", source.name,
+                "-ac", "1", "-ar", "16000",
+                # Drop any silence longer than a second, wherever it occurs
+                "-af", "silenceremove=start_periods=1:stop_periods=-1:stop_duration=1:stop_threshold=-45dB",
+                "-c:a", "libopus", "-b:a", "24k", "-f", "ogg", "pipe:1",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+
+            async def read_output():
+                while chunk := await process.stdout.read(UPLOAD_CHUNK_SIZE):
+                    processed.write(chunk)
 
-def groq_transcribe(buffer_data, api_key):
+            _, error_output = await asyncio.gather(read_output(), process.stderr.read())
+            await process.wait()
+    except asyncio.CancelledError:
+        stop_ffmpeg()
+        raise
+    except Exception as e:
+        # Starting ffmpeg, reading its output or writing the temp files failed
+        stop_ffmpeg()
+        if process is not None:
+            await process.wait()
+        print(f"Audio preprocessing failed, sending original audio: {str(e)}")
+        audio_file.seek(0)
+        return audio_file, filename, content_type, stats
+
+    processed_size = processed.tell()
+    if process.returncode != 0 or processed_size == 0:
+        print(f"Audio preprocessing failed, sending original audio: {error_output.decode(errors='replace')[:200]}")
+        processed.close()
+        audio_file.seek(0)
+        return audio_file, filename, content_type, stats
+
+    stats["processed_bytes"] = processed_size
+    stats["reduction"] = 1 - processed_size / original_size if original_size else 0.0
+    print(f"Audio preprocessed from {original_size} to {processed_size} bytes ({stats['reduction']:.0%} smaller)")
+    return processed, "audio.ogg", "audio/ogg", stats
+
+async def groq_transcribe(audio_file, api_key, filename="audio.mp3", content_type="audio/mpeg"):
     url = "https://api.groq.com/openai/v1/audio/transcriptions"
     headers = {
         "Authorization": f"Bearer {api_key}"
     }
-    files = {
-        "file": ("audio.mp3", io.BytesIO(buffer_data), "audio/mpeg"),
-        "model": (None, "whisper-large-v3"),
-        "response_format": (None, "verbose_json")
-    }
+    form = aiohttp.FormData()
+    form.add_field("file", read_chunks(audio_file), filename=filename, content_type=content_type)
+    form.add_field("model", "whisper-large-v3")
+    form.add_field("response_format", "verbose_json")
     
-    response = requests.post(url, headers=headers, files=files)
-    
-    if response.status_code == 200:
-        transcribe = response.json()
-        transcribed_str = transcribe['text']
-    else:
-        raise Exception(f"Groq API request failed with status code {response.status_code}: {response.text}")
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, headers=headers, data=form) as response:
+            if response.status == 200:
+                transcribe = await response.json()
+                transcribed_str = transcribe['text']
+            else:
+                error_text = await response.text()
+                raise upstream_error(
+                    "Groq",
+                    response.status,
+                    f"status code {response.status}: {error_text}",
+                    response.headers
+                )
     
     return transcribed_str 
 
+def upstream_error(provider, status, error_text, headers):
+    """
+    Builds an HTTPException carrying the provider's status and Retry-After so the limiter can retry it
+    """
+    retry_after = headers.get("Retry-After")
+    return HTTPException(
+        status_code=status,
+        detail=f"{provider} API request failed: {error_text}",
+        headers={"Retry-After": retry_after} if retry_after else None
+    )
+
+async def post_deepgram(session, url, headers, chunk):
+    async with session.post(url, headers=headers, data=chunk) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            raise upstream_error("Deepgram", response.status, error_text, response.headers)
+        
+        return await response.read()
+
+async def post_together(url, headers, payload):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, headers=headers, json=payload) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise upstream_error("Together AI", response.status, error_text, response.headers)
+            
+            return await response.json()
+
 @router.post("/ai/gen-audio")
 async def generate_audio(request: TextToSpeechRequest):
     """
@@ -554,16 +1465,8 @@ async def generate_audio(request: TextToSpeechRequest):
                 
                 url = "https://api.deepgram.com/v1/speak?model=aura-asteria-en"
                 
-                async with session.post(url, headers=headers, data=chunk) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        raise HTTPException(
-                            status_code=response.status,
-                            detail=f"Deepgram API request failed: {error_text}"
-                        )
-                    
-                    audio_chunk = await response.read()
-                    audio_chunks.append(audio_chunk)
+                audio_chunk = await limiters["deepgram"].call(post_deepgram, session, url, headers, chunk)
+                audio_chunks.append(audio_chunk)
         
         # Combine all audio chunks
         combined_audio = b''.join(audio_chunks)
@@ -607,34 +1510,25 @@ async def generate_image(request: ImageGenerationRequest):
             "response_format": "b64_json"
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise HTTPException(
-                        status_code=response.status,
-                        detail=f"Together AI API request failed: {error_text}"
-                    )
-                
-                result = await response.json()
-                
-                # Extract base64 image data
-                if "data" in result and len(result["data"]) > 0:
-                    image_data = result["data"][0]["b64_json"]
-                    
-                    # Return the image with appropriate headers
-                    return Response(
-                        content=base64.b64decode(image_data),
-                        media_type="image/png",
-                        headers={
-                            "Content-Disposition": "attachment; filename=generated_image.png"
-                        }
-                    )
-                else:
-                    raise HTTPException(
-                        status_code=500,
-                        detail="No image data received from API"
-                    )
+        result = await limiters["together"].call(post_together, url, headers, payload)
+        
+        # Extract base64 image data
+        if "data" in result and len(result["data"]) > 0:
+            image_data = result["data"][0]["b64_json"]
+            
+            # Return the image with appropriate headers
+            return Response(
+                content=base64.b64decode(image_data),
+                media_type="image/png",
+                headers={
+                    "Content-Disposition": "attachment; filename=generated_image.png"
+                }
+            )
+        else:
+            raise HTTPException(
+                status_code=500,
+                detail="No image data received from API"
+            )
 
     except Exception as e:
         print(f"Error in generate_image: {str(e)}")
@@ -666,34 +1560,25 @@ async def generate_image(query):
             "response_format": "b64_json"
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise HTTPException(
-                        status_code=response.status,
-                        detail=f"Together AI API request failed: {error_text}"
-                    )
-                
-                result = await response.json()
-                
-                # Extract base64 image data
-                if "data" in result and len(result["data"]) > 0:
-                    image_data = result["data"][0]["b64_json"]
-                    
-                    # Return the image with appropriate headers
-                    return Response(
-                        content=base64.b64decode(image_data),
-                        media_type="image/png",
-                        headers={
-                            "Content-Disposition": "attachment; filename=generated_image.png"
-                        }
-                    )
-                else:
-                    raise HTTPException(
-                        status_code=500,
-                        detail="No image data received from API"
-                    )
+        result = await limiters["together"].call(post_together, url, headers, payload)
+        
+        # Extract base64 image data
+        if "data" in result and len(result["data"]) > 0:
+            image_data = result["data"][0]["b64_json"]
+            
+            # Return the image with appropriate headers
+            return Response(
+                content=base64.b64decode(image_data),
+                media_type="image/png",
+                headers={
+                    "Content-Disposition": "attachment; filename=generated_image.png"
+                }
+            )
+        else:
+            raise HTTPException(
+                status_code=500,
+                detail="No image data received from API"
+            )
 
     except Exception as e:
         print(f"Error in generate_image: {str(e)}")
@@ -705,34 +1590,49 @@ async def store_feedback(feedback_data: FeedbackRequest):
     Endpoint to store interaction feedback in history
     """
     try:
-        # Extract base64 image if present in output
-        material = ""
-        if "data:image/png;base64," in feedback_data.output:
-            start_idx = feedback_data.output.find("data:image/png;base64,")
-            material = feedback_data.output[start_idx:]
-            # If there's content after the base64 string, trim it
-            if "\n" in material:
-                material = material.split("\n")[0]
+        interaction_key = f"interaction:{feedback_data.interaction_id}"
+        interaction = await data.get(interaction_key)
+        if interaction is None:
+            raise HTTPException(status_code=404, detail="Interaction not found")
+        # Each interaction is learned from once, a repeated or concurrent post loses the compare_and_set
+        if interaction.get("feedback_given") or not await data.compare_and_set(
+            interaction_key, interaction, FEEDBACK_GIVEN, ttl=INTERACTION_TTL
+        ):
+            raise HTTPException(status_code=409, detail="Feedback was already given for this interaction")
 
         # Create history entry
         history_entry = {
-            "request": feedback_data.request,
-            "material": material,  # Store extracted base64 image string
-            "output": feedback_data.output,
+            "request": interaction["request"],
+            "material": interaction["material"],
+            # Interactions recorded before answers were stored without their image may still embed it
+            "output": INLINE_IMAGE.sub("", interaction["output"]),
             "feedback": feedback_data.feedback
         }
         
         # Add to history array in data singleton
-        data["history"].append(history_entry)
-        
-        # Write data to file
-        
-        print("Data:", data)
+        await data.append("history", history_entry)
+        await record_feedback(feedback_data.feedback)
+        print(f"Feedback stored for interaction {feedback_data.interaction_id}")
+
+        # Learn only once the statistics call for it
+        learn_job_id = None
+        reason = await learn_trigger() if AUTO_LEARN else None
+        if reason:
+            try:
+                learn_job_id = await submit_learn_job()
+                await record_auto_learn(learn_job_id, reason)
+                print(f"Started learn job {learn_job_id}: {reason}")
+            except HTTPException as e:
+                print(f"Could not start learn job: {e.detail}")
+
         return {
             "status": "success",
-            "message": "Feedback stored successfully"
+            "message": "Feedback stored successfully",
+            "learn_job_id": learn_job_id
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error storing feedback: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
@@ -1,10 +1,103 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel, Field
+from typing import Literal, Optional
+from singletons.limiter import limiters
+from singletons.hedge import hedgers
+from singletons.memory import structure_sizes, allocation_report, peak_rss_bytes
+from singletons.models import DEFAULT_ROUTES, telemetry, model_route, set_model_route, known_models
+from singletons import cancellation
+from singletons.admission import gates
+import asyncio
 
 router = APIRouter()
 
+class ModelRoute(BaseModel):
+    model: Optional[str] = None
+    max_tokens: Optional[int] = Field(None, gt=0)  # stage_chat treats 0 as no cap at all
+    detail: Optional[Literal["low", "high", "auto"]] = None
+
 @router.get("/debug")
 async def debug():
     """
     Debug endpoint that returns a test response
     """
-    return {"status": "ok", "message": "Debug endpoint working"}
\ No newline at end of file
+    return {"status": "ok", "message": "Debug endpoint working"}
+
+@router.get("/debug/rate-limits")
+async def rate_limits():
+    """
+    Debug endpoint that reports per-provider request counts, retries and queue wait times
+    """
+    return {name: limiter.metrics() for name, limiter in limiters.items()}
+
+@router.get("/debug/hedging")
+async def hedging():
+    """
+    Debug endpoint that reports per-provider hedge counts and wins
+    """
+    return {name: hedger.metrics() for name, hedger in hedgers.items()}
+
+@router.get("/debug/memory")
+async def memory(top: int = 10):
+    """
+    Debug endpoint that reports the size of in-process structures and, when MEMORY_TRACE_FRAMES
+    is set, the top allocation sites and their growth since the previous call
+    """
+    return {
+        "peak_rss_bytes": peak_rss_bytes(),
+        "structures": structure_sizes(),
+        "tracemalloc": await asyncio.to_thread(allocation_report, top)
+    }
+
+@router.get("/debug/models")
+async def models():
+    """
+    Debug endpoint that reports the model route of every stage with its latency, token and cost totals
+    """
+    return {
+        stage: {"route": await model_route(stage), "telemetry": telemetry[stage].metrics()}
+        for stage in DEFAULT_ROUTES
+    }
+
+@router.put("/debug/models/{stage}")
+async def update_model_route(stage: str, route: ModelRoute):
+    """
+    Overrides the model, max_tokens or image detail of a stage for every worker.
+    Fields left out keep their startup value, an empty body restores the startup route.
+    """
+    if stage not in DEFAULT_ROUTES:
+        raise HTTPException(status_code=404, detail=f"Unknown stage: {stage}")
+    if route.model is not None and route.model not in known_models():
+        raise HTTPException(status_code=400, detail=f"Unknown model: {route.model}, expected one of {sorted(known_models())}")
+    return await set_model_route(stage, route.dict(exclude_none=True))
+
+@router.get("/debug/cancellations")
+async def cancellations():
+    """
+    Debug endpoint that reports work cancelled because clients disconnected or stopped polling,
+    and the provider calls each limiter saw cancelled by client disconnects and for other reasons.
+    Losing hedge requests are reported by /debug/hedging instead.
+    """
+    return {
+        **cancellation.metrics(),
+        "cancelled_provider_calls": {
+            name: {
+                "disconnects": {
+                    "calls": limiter.stats["disconnect_cancelled"],
+                    "estimated_tokens": limiter.stats["disconnect_cancelled_tokens"],
+                },
+                "other": {
+                    "calls": limiter.stats["cancelled"],
+                    "estimated_tokens": limiter.stats["cancelled_tokens"],
+                },
+            }
+            for name, limiter in limiters.items()
+        }
+    }
+
+@router.get("/debug/admission")
+async def admission():
+    """
+    Debug endpoint that reports per-endpoint running and queued requests, waits, rejections and degraded admissions
+    """
+    return {name: gate.metrics() for name, gate in gates.items()}
@@ -1,37 +1,51 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import openai
 import os
-import chromadb
-from chromadb.config import Settings
 import json
+import base64
+import uuid
+import asyncio
+from singletons.models import stage_chat
+from singletons.vectors import vector_namespaces
+from singletons.uploads import parse_upload_form, form_file
+from singletons.admission import gates
 
 router = APIRouter()
 
+MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", 20 * 1024 * 1024))
+
 # Pydantic models
 class WebSearchRequest(BaseModel):
     prompt: str
     image_base64: str
+    session_id: Optional[str] = None  # Searches reuse content scraped earlier in the same session...
+    doc_id: Optional[str] = None  # ...or for the same document, and only see that content
 
 class SearchResult(BaseModel):
     chat_response: str
     sources: List[str]
 
-# Initialize ChromaDB client in-memory
-chroma_client = chromadb.Client(Settings(is_persistent=False))
-collection = chroma_client.create_collection(name="web_search_results")
+def search_namespace(session_id: Optional[str], doc_id: Optional[str]) -> Optional[str]:
+    """Vector store namespace of a search, None when it has neither a document nor a session"""
+    if doc_id:
+        return f"doc:{doc_id}"
+    if session_id:
+        return f"session:{session_id}"
+    return None
 
 async def generate_search_queries(prompt: str, image_base64: str, user_persona: str) -> List[str]:
-    """Generate search queries using GPT-4V based on the image and prompt"""
-    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    """Generate search queries with a vision model based on the image and prompt"""
+    client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
     
     system_prompt = f"""Given the user's request and an image of their study material, generate {3} specific search queries 
     that would help find relevant information online. Return the queries in a JSON array format.
     Consider the user's learning style and needs: {user_persona}"""
     
-    response = client.chat.completions.create(
-        model="gpt-4-vision-preview",
+    response = await stage_chat(
+        client,
+        "search_queries",
         messages=[
             {
                 "role": "system",
@@ -66,71 +80,119 @@ async def scrape_url(url: str) -> str:
     # TODO: Implement actual web scraping
     return f"Sample content scraped from {url}"
 
-async def process_and_store_content(content: str, source_url: str):
-    """Process content and store in ChromaDB"""
+async def process_and_store_content(content: str, source_url: str, namespace: str):
+    """Process content and store it in the namespace's ChromaDB collection"""
     # TODO: Implement actual content chunking
     chunks = [content[i:i+500] for i in range(0, len(content), 500)]
     
-    # Store chunks in ChromaDB with metadata
-    for i, chunk in enumerate(chunks):
-        collection.add(
-            documents=[chunk],
-            metadatas=[{"source_url": source_url}],
-            ids=[f"{source_url}_{i}"]
-        )
+    # Store chunks in ChromaDB with metadata, embedding them in a thread
+    await asyncio.to_thread(
+        vector_namespaces.add,
+        namespace,
+        ids=[f"{source_url}_{i}" for i in range(len(chunks))],
+        documents=chunks,
+        metadatas=[{"source_url": source_url} for _ in chunks]
+    )
 
 @router.post("/websearch")
 async def web_search(request: WebSearchRequest) -> SearchResult:
     """Main endpoint for web search functionality"""
     try:
-        # Generate search queries using GPT-4V
-        search_queries = await generate_search_queries(
+        return await admitted_search(
             request.prompt,
             request.image_base64,
-            "default_persona"  # TODO: Get from data singleton
-        )
-        
-        # Get URLs for each query
-        all_urls = []
-        for query in search_queries:
-            urls = await get_top_urls(query)
-            all_urls.extend(urls)
-        
-        # Scrape and store content
-        for url in all_urls:
-            content = await scrape_url(url)
-            await process_and_store_content(content, url)
-        
-        # Perform similarity search
-        query_embedding = "TODO"  # TODO: Get embedding from Together AI
-        results = collection.query(
-            query_texts=[request.prompt],
-            n_results=5
+            search_namespace(request.session_id, request.doc_id)
         )
-        
-        # Generate final response with GPT-4
-        context = "\n".join(results['documents'][0])
-        sources = [meta["source_url"] for meta in results['metadatas'][0]]
-        
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful AI tutor. Use the provided context to answer the user's question."
-                },
-                {
-                    "role": "user",
-                    "content": f"Context:\n{context}\n\nQuestion: {request.prompt}"
-                }
-            ]
-        )
-        
-        return SearchResult(
-            chat_response=response.choices[0].message.content,
-            sources=sources
-        )
-        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/websearch/upload")
+async def web_search_upload(request: Request) -> SearchResult:
+    """Multipart variant of /websearch taking "prompt", optional "session_id" and "doc_id" fields and the image as raw bytes in a "file" field"""
+    form = None
+    try:
+        form = await parse_upload_form(request, MAX_IMAGE_SIZE)
+        prompt = form.get("prompt")
+        if not isinstance(prompt, str):
+            raise HTTPException(status_code=400, detail="Missing prompt field")
+        image_base64 = base64.b64encode(await form_file(form).read()).decode("utf-8")
+        namespace = search_namespace(form.get("session_id"), form.get("doc_id"))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"File upload failed: {str(e)}")
+    finally:
+        if form is not None:
+            await form.close()
+
+    try:
+        return await admitted_search(prompt, image_base64, namespace)
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def admitted_search(prompt: str, image_base64: str, namespace: Optional[str] = None) -> SearchResult:
+    """Searches once the websearch admission gate lets the request in, with a single query when its queue is deep"""
+    async with gates["websearch"].admit() as degraded:
+        if namespace is not None:
+            return await search_and_answer(prompt, image_base64, namespace, max_queries=1 if degraded else None)
+
+        # Without a session the scraped content only serves this request
+        namespace = f"request:{uuid.uuid4().hex}"
+        try:
+            return await search_and_answer(prompt, image_base64, namespace, max_queries=1 if degraded else None)
+        finally:
+            await asyncio.to_thread(vector_namespaces.drop, namespace)
+
+async def search_and_answer(prompt: str, image_base64: str, namespace: str, max_queries: int = None) -> SearchResult:
+    """Searches the web for material related to the image and prompt and answers from the content scraped into namespace"""
+    # Generate search queries from the image and prompt
+    search_queries = await generate_search_queries(
+        prompt,
+        image_base64,
+        "default_persona"  # TODO: Get from data singleton
+    )
+    search_queries = search_queries[:max_queries]
+    
+    # Get URLs for each query
+    all_urls = []
+    for query in search_queries:
+        urls = await get_top_urls(query)
+        all_urls.extend(urls)
+    
+    # Scrape and store content
+    for url in all_urls:
+        content = await scrape_url(url)
+        await process_and_store_content(content, url, namespace)
+    
+    # Perform similarity search
+    query_embedding = "TODO"  # TODO: Get embedding from Together AI
+    documents, metadatas = await asyncio.to_thread(vector_namespaces.query, namespace, prompt, n_results=5)
+    
+    # Generate final response
+    context = "\n".join(documents)
+    sources = [meta["source_url"] for meta in metadatas]
+    
+    client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    response = await stage_chat(
+        client,
+        "search_answer",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a helpful AI tutor. Use the provided context to answer the user's question."
+            },
+            {
+                "role": "user",
+                "content": f"Context:\n{context}\n\nQuestion: {prompt}"
+            }
+        ]
+    )
+    
+    return SearchResult(
+        chat_response=response.choices[0].message.content,
+        sources=sources
+    )
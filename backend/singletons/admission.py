@@ -0,0 +1,149 @@
+"""
+Admission control for the expensive endpoints, so a burst of requests queues or
+is shed instead of slowing every request down.
+
+Each gate runs at most max_concurrent requests at once per worker. Further
+requests wait in a FIFO queue of at most max_queue entries for up to
+queue_timeout seconds. When the queue is full or the wait times out, the
+request is refused straight away with a 503 and a Retry-After estimated from
+recent service times. Requests that join a queue at least degrade_depth deep
+are admitted in degraded mode, and the endpoint skips optional work for them.
+
+Limits are read from the environment, e.g. MULTIMODAL_MAX_CONCURRENT,
+MULTIMODAL_MAX_QUEUE, MULTIMODAL_QUEUE_TIMEOUT and MULTIMODAL_DEGRADE_QUEUE.
+They apply to all API workers together. Gates live in each worker, so every
+worker takes a 1/WORKERS share of the count limits (see singletons/state.py).
+"""
+import asyncio
+import collections
+import contextlib
+import math
+import os
+import time
+
+from fastapi import HTTPException
+
+from singletons.state import WORKERS
+
+class AdmissionGate:
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout, degrade_depth):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.degrade_depth = degrade_depth
+        self.running = 0
+        self.waiters = collections.deque()  # Futures of queued requests, oldest first
+        self.service_times = collections.deque(maxlen=100)
+        self.stats = {
+            "admitted": 0,
+            "degraded": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+
+    def retry_after(self):
+        """
+        Seconds until the queue has likely drained enough to admit another request
+        """
+        average = sum(self.service_times) / len(self.service_times) if self.service_times else 1
+        return min(60, max(1, math.ceil(average * (len(self.waiters) + 1) / self.max_concurrent)))
+
+    def busy(self, reason):
+        print(f"{self.name} request refused: {reason}")
+        return HTTPException(
+            status_code=503,
+            detail=f"Server is busy ({reason}), try again later",
+            headers={"Retry-After": str(self.retry_after())}
+        )
+
+    async def enter(self):
+        """
+        Waits for a free slot and returns whether the request should run degraded
+        """
+        if self.running < self.max_concurrent and not self.waiters:
+            self.running += 1
+            self.stats["admitted"] += 1
+            return False
+        if len(self.waiters) >= self.max_queue:
+            self.stats["rejected_queue_full"] += 1
+            raise self.busy("queue full")
+
+        degraded = len(self.waiters) >= self.degrade_depth
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats["rejected_timeout"] += 1
+            raise self.busy(f"waited {self.queue_timeout}s")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.leave()  # A slot was handed over just as the caller gave up
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+        waited = time.monotonic() - started
+        self.stats["admitted"] += 1
+        self.stats["degraded"] += degraded
+        self.stats["total_wait_seconds"] += waited
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+        return degraded
+
+    def leave(self):
+        # Hand the slot straight to the oldest waiter, so newcomers cannot overtake the queue
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        """
+        Holds a slot for the duration of the block, which receives whether to run degraded
+        """
+        degraded = await self.enter()
+        started = time.monotonic()
+        try:
+            yield degraded
+        finally:
+            self.service_times.append(time.monotonic() - started)
+            self.leave()
+
+    def metrics(self):
+        return {
+            **self.stats,
+            "running": self.running,
+            "queued": len(self.waiters),
+            "average_wait_seconds": self.stats["total_wait_seconds"] / max(1, self.stats["admitted"]),
+            "average_service_seconds": sum(self.service_times) / max(1, len(self.service_times)),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "degrade_depth": self.degrade_depth,
+        }
+
+def worker_share(limit):
+    # A limit of 0 keeps its meaning, any other leaves each worker at least 1
+    return max(1, limit // WORKERS) if limit > 0 else limit
+
+def gate_from_env(name, prefix, max_concurrent, max_queue, queue_timeout, degrade_depth):
+    return AdmissionGate(
+        name,
+        worker_share(int(os.getenv(f"{prefix}_MAX_CONCURRENT", max_concurrent))),
+        worker_share(int(os.getenv(f"{prefix}_MAX_QUEUE", max_queue))),
+        float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", queue_timeout)),
+        worker_share(int(os.getenv(f"{prefix}_DEGRADE_QUEUE", degrade_depth))),
+    )
+
+gates = {
+    "multimodal": gate_from_env("multimodal", "MULTIMODAL", 8, 32, 15, 8),
+    "websearch": gate_from_env("websearch", "WEBSEARCH", 4, 16, 15, 4),
+}
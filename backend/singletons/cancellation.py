@@ -0,0 +1,79 @@
+"""
+Cancellation of request work once nobody is waiting for the result.
+
+Endpoints run their provider calls through cancel_on_disconnect, which polls
+the connection every DISCONNECT_POLL_INTERVAL seconds and cancels the work when
+the client has gone away. Cancelling the task aborts every provider call it is
+awaiting, including requests still queued in a rate limiter, and skips the
+stages that have not started yet.
+
+The work of each request can tell that it is being cancelled because of a
+disconnect through cancelled_by_disconnect, so provider limiters count those
+calls apart from other cancellations such as abandoned learn jobs. Counters of
+cancelled work are reported by /debug/cancellations, next to the calls each
+provider limiter saw cancelled.
+"""
+import asyncio
+import collections
+import contextvars
+import os
+import time
+
+from fastapi import HTTPException
+
+POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", 0.5))
+CLIENT_CLOSED_REQUEST = 499  # Never seen by the client, but shows up in access logs
+
+stats = {
+    "disconnects": 0,
+    "seconds_run_before_disconnect": 0.0,
+    "abandoned_learn_jobs": 0,
+}
+disconnects_by_endpoint = collections.Counter()
+# Shared by the tasks of one request's work, flipped when its client disconnects
+disconnect_state = contextvars.ContextVar("disconnect_state", default=None)
+
+def cancelled_by_disconnect():
+    """
+    Returns True if the current work is being cancelled because its client disconnected
+    """
+    state = disconnect_state.get()
+    return state is not None and state["disconnected"]
+
+def record_disconnect(endpoint, started):
+    stats["disconnects"] += 1
+    stats["seconds_run_before_disconnect"] += time.monotonic() - started
+    disconnects_by_endpoint[endpoint] += 1
+    print(f"Client disconnected from {endpoint}, cancelled its remaining work")
+
+async def cancel_on_disconnect(request, work):
+    """
+    Awaits the coroutine work, cancelling it if the client of request disconnects first
+    """
+    started = time.monotonic()
+    state = {"disconnected": False}
+    token = disconnect_state.set(state)
+    try:
+        # The task and every task it starts copy the context holding state
+        task = asyncio.ensure_future(work)
+    finally:
+        disconnect_state.reset(token)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                state["disconnected"] = True
+                task.cancel()
+                record_disconnect(request.url.path, started)
+                raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+    finally:
+        if not task.done():
+            task.cancel()
+
+def metrics():
+    return {
+        **stats,
+        "disconnects_by_endpoint": dict(disconnects_by_endpoint),
+    }
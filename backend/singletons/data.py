@@ -1,10 +1,24 @@
 """
 Data singleton to store application state.
 
+State lives in the store selected by STATE_BACKEND (see singletons/state.py), so
+every API worker sees the same persona and history. data is awaitable, code
+running in a worker thread uses data.sync instead. It holds these keys:
+
+"initial_data:<role>": str   # Transcript for the teacher, parent or student role
+"student_persona": str       # Set by /ai/create-user-persona, otherwise only replaced with compare_and_set
+"persona_history": list      # Recent persona versions for rollback, see singletons/persona.py
+"persona_version": int       # Number of the newest persona version
+"history": list              # Interaction objects with feedback, appended atomically
+"history_version": int       # Bumped whenever learning retires a snapshot of history
+"interaction:<id>": dict     # Interaction objects awaiting feedback, see below
+"learn_job:<id>": dict       # Learn jobs, see singletons/jobs.py
+"document:<id>": dict        # Uploaded PDF documents, see singletons/documents.py
+
 History objects have the following structure:
 {
     "request": str,      # The request/question from the user
-    "material": str,     # The learning material or content in image url format
+    "material": str,     # The learning material in image url format, or "doc://<id>/<page>" for an uploaded document page
     "output": str,        # The output/answer given to the user
     "feedback": str,     # Feedback provided for the interaction
     "score": {          # Added during learning process
@@ -12,14 +26,41 @@ History objects have the following structure:
         "reason": str   # Explanation for the score
     }
 }
+
+Interaction objects are recorded by /ai/call-multimodal under an interaction id
+so that feedback can reference them without resending the output:
+{
+    "request": str,      # The request/question from the user
+    "material": str,     # The learning material in image url format
+    "output": str        # The output/answer given to the user
+}
+Once its feedback is stored, an interaction is replaced by {"feedback_given": True}
+until it expires, so the same interaction cannot enter history twice.
 """
+from singletons.state import AsyncStore, create_store
+from singletons.memory import register_structure
+
+ROLES = ("teacher", "parent", "student")
+INTERACTION_TTL = 24 * 60 * 60  # Seconds an interaction waits for feedback before it is dropped
+
+data = AsyncStore(create_store())
+register_structure("state", data.metrics)
+
+async def get_initial_data():
+    return {role: await data.get(f"initial_data:{role}", "") for role in ROLES}
+
+async def snapshot_history():
+    """
+    Returns (version, entries) for the history as it is now. Feedback stored later
+    is appended after these entries and is not part of the snapshot.
+    """
+    return await data.get("history_version"), tuple(await data.get_list("history"))
 
-data = {
-    "initial_data":{
-        "teacher":"",
-        "parent":"",
-        "student":""
-    },
-    "student_persona":"",
-    "history":[],  # Array of interaction objects as described above
-}
\ No newline at end of file
+async def retire_history(version, count):
+    """
+    Removes the first count history entries, which a snapshot taken at version covered.
+    Returns False and keeps history if another learn run retired entries since the snapshot.
+    The version bump and the trim are one atomic store operation, so no other worker
+    can snapshot entries that are about to be removed.
+    """
+    return await data.compare_and_trim("history_version", version, (version or 0) + 1, "history", count)
@@ -0,0 +1,225 @@
+"""
+Uploaded PDF documents and a bounded cache of their rasterized pages.
+
+PDFs are written to DOCUMENTS_DIR so every worker can open them. Their metadata
+and the text of every page, extracted once at upload, live in the data singleton:
+"document:<id>": {
+    "id": str,
+    "filename": str,
+    "pages": int,         # Page count, pages are numbered from 1
+    "texts": [str],       # Extracted text of each page
+    "created_at": str
+}
+
+Documents expire DOCUMENT_TTL seconds after upload. Every upload sweeps
+DOCUMENTS_DIR, deleting the PDFs whose entry has expired, then the oldest
+documents until the PDFs fit in DOCUMENTS_MAX_BYTES. Interactions about an
+expired document are evaluated without its page image.
+
+Pages are rasterized on first use at a size suited to GPT-4o vision and kept in
+an in-process LRU cache of at most RASTER_CACHE_BYTES. Interactions reference a
+page as "doc://<id>/<page>" instead of carrying the image.
+
+Needs PyMuPDF, which is only imported when a document is used. Every function
+here blocks on disk or state store I/O, so async code runs them in a thread.
+"""
+import base64
+import collections
+import datetime
+import os
+import tempfile
+import threading
+import time
+
+from singletons.data import data
+from singletons.memory import register_structure
+
+DOCUMENTS_DIR = os.getenv("DOCUMENTS_DIR") or os.path.join(tempfile.gettempdir(), "adapt-learner-documents")
+DOCUMENT_TTL = int(os.getenv("DOCUMENT_TTL", 7 * 24 * 60 * 60))
+DOCUMENTS_MAX_BYTES = int(os.getenv("DOCUMENTS_MAX_BYTES", 1024 * 1024 * 1024))
+ORPHAN_GRACE_SECONDS = 60  # A PDF this new may still be waiting for its entry in another worker
+RASTER_CACHE_BYTES = int(os.getenv("RASTER_CACHE_BYTES", 64 * 1024 * 1024))
+# GPT-4o high detail scales images to fit 2048 px, then the shortest side to 768 px
+VISION_SHORT_SIDE = 768
+VISION_LONG_SIDE = 2048
+JPEG_QUALITY = 85
+
+class DocumentError(Exception):
+    pass
+
+class RasterCache:
+    """
+    LRU cache of rendered pages bounded by total bytes
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.pages = collections.OrderedDict()  # (doc_id, page) -> JPEG bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            image = self.pages.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.pages.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self.pages:
+                return
+            self.pages[key] = image
+            self.size += len(image)
+            while self.size > self.max_bytes and len(self.pages) > 1:
+                _, evicted = self.pages.popitem(last=False)
+                self.size -= len(evicted)
+
+    def drop(self, doc_id):
+        with self.lock:
+            for key in [key for key in self.pages if key[0] == doc_id]:
+                self.size -= len(self.pages.pop(key))
+
+    def metrics(self):
+        return {
+            "pages": len(self.pages),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+raster_cache = RasterCache(RASTER_CACHE_BYTES)
+register_structure("raster_cache", raster_cache.metrics)
+
+def document_path(doc_id):
+    return os.path.join(DOCUMENTS_DIR, f"{doc_id}.pdf")
+
+def ingest_pdf(pdf_file, doc_id, filename):
+    """
+    Saves an uploaded PDF and extracts the text of every page. Blocking, run it in a thread.
+    """
+    import pymupdf
+
+    os.makedirs(DOCUMENTS_DIR, exist_ok=True)
+    pdf_file.seek(0)
+    with open(document_path(doc_id), "wb") as f:
+        while chunk := pdf_file.read(1024 * 1024):
+            f.write(chunk)
+
+    try:
+        with pymupdf.open(document_path(doc_id)) as pdf:
+            texts = [page.get_text() for page in pdf]
+    except Exception as e:
+        print(f"Could not read PDF {filename}: {str(e)}")
+        os.remove(document_path(doc_id))
+        raise DocumentError("File is not a readable PDF")
+
+    document = {
+        "id": doc_id,
+        "filename": filename,
+        "pages": len(texts),
+        "texts": texts,
+        "created_at": datetime.datetime.now().isoformat()
+    }
+    data.sync.set(f"document:{doc_id}", document, ttl=DOCUMENT_TTL)
+    sweep_documents(keep=doc_id)
+    return document
+
+def delete_document(doc_id):
+    data.sync.delete(f"document:{doc_id}")
+    try:
+        os.remove(document_path(doc_id))
+    except FileNotFoundError:
+        pass
+    raster_cache.drop(doc_id)
+
+def sweep_documents(keep=None):
+    """
+    Deletes expired documents, then the oldest ones other than keep until the stored
+    PDFs fit in DOCUMENTS_MAX_BYTES. Blocking, run it in a thread.
+    """
+    now = time.time()
+    stored = []  # (modified at, doc_id, bytes)
+    for name in os.listdir(DOCUMENTS_DIR):
+        if not name.endswith(".pdf"):
+            continue
+        doc_id = name[:-len(".pdf")]
+        try:
+            stat = os.stat(document_path(doc_id))
+        except FileNotFoundError:
+            continue  # Deleted by another worker meanwhile
+        age = now - stat.st_mtime
+        if doc_id != keep and (age > DOCUMENT_TTL or (
+            age > ORPHAN_GRACE_SECONDS and data.sync.get(f"document:{doc_id}") is None
+        )):
+            delete_document(doc_id)
+        else:
+            stored.append((stat.st_mtime, doc_id, stat.st_size))
+
+    total = sum(size for _, _, size in stored)
+    for _, doc_id, size in sorted(stored):
+        if total <= DOCUMENTS_MAX_BYTES:
+            break
+        if doc_id != keep:
+            print(f"Documents exceed {DOCUMENTS_MAX_BYTES} bytes, deleting document {doc_id}")
+            delete_document(doc_id)
+            total -= size
+
+def get_document(doc_id):
+    document = data.sync.get(f"document:{doc_id}")
+    if document is None:
+        raise DocumentError(f"Document {doc_id} not found")
+    return document
+
+def page_text(doc_id, page):
+    document = get_document(doc_id)
+    if not 1 <= page <= document["pages"]:
+        raise DocumentError(f"Page {page} out of range, document has {document['pages']} pages")
+    return document["texts"][page - 1]
+
+def render_page(doc_id, page):
+    """
+    Returns a page as JPEG bytes, rasterizing it on first use. Blocking, run it in a thread.
+    """
+    page_text(doc_id, page)  # Validates the document and page number, even for cached pages of an expired one
+    image = raster_cache.get((doc_id, page))
+    if image is not None:
+        return image
+
+    import pymupdf
+
+    if not os.path.exists(document_path(doc_id)):
+        raise DocumentError(f"Document {doc_id} not found")  # Deleted by a sweep just now
+    with pymupdf.open(document_path(doc_id)) as pdf:
+        pdf_page = pdf[page - 1]
+        short_side = min(pdf_page.rect.width, pdf_page.rect.height)
+        long_side = max(pdf_page.rect.width, pdf_page.rect.height)
+        scale = min(VISION_SHORT_SIDE / short_side, VISION_LONG_SIDE / long_side)
+        pixmap = pdf_page.get_pixmap(matrix=pymupdf.Matrix(scale, scale), alpha=False)
+        image = pixmap.tobytes("jpeg", jpg_quality=JPEG_QUALITY)
+
+    raster_cache.put((doc_id, page), image)
+    return image
+
+def page_material(doc_id, page):
+    return f"doc://{doc_id}/{page}"
+
+def resolve_material(material):
+    """
+    Turns a stored material reference into an image URL the model accepts, or None if its
+    document has expired. Blocking, run it in a thread.
+    """
+    if not material or not material.startswith("doc://"):
+        return material
+    doc_id, page = material[len("doc://"):].rsplit("/", 1)
+    try:
+        image = render_page(doc_id, int(page))
+    except DocumentError as e:
+        print(f"Material {material} is no longer available: {str(e)}")
+        return None
+    return f"data:image/jpeg;base64,{base64.b64encode(image).decode('utf-8')}"
@@ -0,0 +1,190 @@
+"""
+Rolling feedback and score statistics that decide when the server should learn.
+
+Every stored feedback gets a cheap polarity signal between -1 and 1 from its
+wording, where a negator flips the cue word that follows it ("not helpful",
+"didn't understand") and a trailing "nothing" flips the one before it
+("understood nothing"). Signals are kept in the "feedback_signals" list of the data singleton and trimmed
+to the most recent MAX_SIGNALS values. Statistics are computed over that list
+as a float32 array. Learning is triggered when the recent window is
+significantly worse than the older feedback, or when enough unlearned feedback
+has accumulated, and never while an automatic learn job is still active or
+cooling down.
+
+Only history appended since the last automatic trigger counts as evidence, so
+a failed run, which leaves its history in place, is not retried on the same
+entries. Each consecutive failure doubles the cooldown, starting from
+AUTO_LEARN_FAILURE_BACKOFF seconds. A successful learn run clears the feedback
+signals, since they judged the persona it replaced, so the drop test starts
+from a fresh baseline.
+
+The last automatic trigger is stored under "auto_learn":
+{
+    "job_id": str,
+    "reason": str,
+    "at": float,           # Unix time of the trigger
+    "history_version": int,  # History version and length when it triggered
+    "history_length": int,
+    "failures": int        # Consecutive failed automatic runs before this one
+}
+
+Average scores of finished learn runs are kept in "learn_scores" for reporting.
+"""
+import os
+import re
+import time
+
+import numpy as np
+
+from singletons.data import data
+from singletons.jobs import get_job
+
+MAX_SIGNALS = 500
+RECENT_WINDOW = 10  # Feedback compared against everything older
+MIN_SAMPLES = 5  # Neither window is trusted with fewer values
+DROP_Z_SCORE = 2.0  # How many standard errors the recent mean must fall
+EVIDENCE_THRESHOLD = int(os.getenv("AUTO_LEARN_EVIDENCE", 20))  # Unlearned history entries that trigger learning
+COOLDOWN_SECONDS = int(os.getenv("AUTO_LEARN_COOLDOWN", 300))
+FAILURE_BACKOFF_SECONDS = int(os.getenv("AUTO_LEARN_FAILURE_BACKOFF", 600))
+MAX_FAILURE_BACKOFF_SECONDS = 24 * 60 * 60
+
+POSITIVE_WORDS = {
+    "good", "great", "helpful", "clear", "love", "like", "liked", "perfect", "thanks", "easy",
+    "understand", "understood", "nice", "awesome", "excellent", "useful", "fun", "better", "amazing",
+}
+NEGATIVE_WORDS = {
+    "bad", "confusing", "confused", "unclear", "hard", "difficult", "boring", "wrong", "hate",
+    "dislike", "useless", "complicated", "worse", "lost", "long",
+}
+NEGATORS = {
+    "not", "no", "never", "don't", "dont", "didn't", "didnt", "doesn't", "doesnt", "isn't", "isnt",
+    "wasn't", "wasnt", "can't", "cant", "cannot", "couldn't", "couldnt", "hardly", "nothing",
+}
+TRAILING_NEGATORS = {"nothing", "none"}  # Also flip a cue just before them
+NEGATION_WINDOW = 3  # Words after a negator, or before a trailing one, that it can reach
+CLAUSE_BREAKS = {".", ",", ";", ":", "!", "?", "but"}  # Negation never reaches past these
+
+def feedback_polarity(feedback):
+    """
+    Scores feedback wording from -1 (all negative cues) to 1 (all positive cues), 0 without cues
+    """
+    words = re.findall(r"[a-z']+|[.,;:!?]", feedback.lower().replace("\u2019", "'"))
+    cues = []  # [polarity, position, negated] of every cue word
+    negate_until = -1  # Last position a pending negator reaches
+    clause_start = 0
+    for position, word in enumerate(words):
+        previous = cues[-1] if cues and cues[-1][1] >= clause_start else None
+        if word in CLAUSE_BREAKS:
+            negate_until = -1
+            clause_start = position + 1
+        elif word in TRAILING_NEGATORS and previous and not previous[2] and position - previous[1] <= NEGATION_WINDOW:
+            previous[0] = -previous[0]
+            previous[2] = True
+        elif word in NEGATORS:
+            negate_until = position + NEGATION_WINDOW
+        elif word in POSITIVE_WORDS or word in NEGATIVE_WORDS:
+            polarity = 1 if word in POSITIVE_WORDS else -1
+            negated = position <= negate_until
+            if negated:
+                polarity = -polarity
+                negate_until = -1  # A negator flips one cue
+            cues.append([polarity, position, negated])
+    if not cues:
+        return 0.0
+    return sum(cue[0] for cue in cues) / len(cues)
+
+async def record_feedback(feedback):
+    length = await data.append("feedback_signals", feedback_polarity(feedback))
+    if length > MAX_SIGNALS:
+        await data.trim_list("feedback_signals", length - MAX_SIGNALS)
+
+async def record_learn_score(average_score):
+    length = await data.append("learn_scores", average_score)
+    if length > MAX_SIGNALS:
+        await data.trim_list("learn_scores", length - MAX_SIGNALS)
+    # Signals so far rated the old persona, the drop test restarts from new feedback
+    await data.delete("feedback_signals")
+
+async def feedback_statistics():
+    signals = np.asarray(await data.get_list("feedback_signals"), dtype=np.float32)
+    scores = np.asarray(await data.get_list("learn_scores"), dtype=np.float32)
+    recent, baseline = signals[-RECENT_WINDOW:], signals[:-RECENT_WINDOW]
+
+    drop_z_score = None
+    if len(recent) >= MIN_SAMPLES and len(baseline) >= MIN_SAMPLES:
+        standard_error = np.sqrt(recent.var() / len(recent) + baseline.var() / len(baseline))
+        drop_z_score = float((baseline.mean() - recent.mean()) / max(standard_error, 1e-6))
+
+    pending_history = await data.list_length("history")
+    history_version = await data.get("history_version")
+    auto_learn = await data.get("auto_learn")
+    new_history = pending_history
+    if auto_learn and auto_learn.get("history_version") == history_version:
+        # Nothing was retired since the last trigger, its entries are still pending
+        new_history = max(0, pending_history - auto_learn.get("history_length", 0))
+
+    return {
+        "feedback_count": len(signals),
+        "recent_feedback_mean": float(recent.mean()) if len(recent) else None,
+        "baseline_feedback_mean": float(baseline.mean()) if len(baseline) else None,
+        "drop_z_score": drop_z_score,
+        "pending_history": pending_history,
+        "new_history": new_history,
+        "history_version": history_version,
+        "learn_runs": len(scores),
+        "last_learn_score": float(scores[-1]) if len(scores) else None,
+        "mean_learn_score": float(scores.mean()) if len(scores) else None,
+        "auto_learn": auto_learn,
+    }
+
+def consecutive_failures(auto_learn, job):
+    if job is not None and job["status"] == "failed":
+        return auto_learn.get("failures", 0) + 1
+    return 0
+
+def cooldown_seconds(failures):
+    if not failures:
+        return COOLDOWN_SECONDS
+    backoff = max(COOLDOWN_SECONDS, FAILURE_BACKOFF_SECONDS) * 2 ** (failures - 1)
+    return min(backoff, MAX_FAILURE_BACKOFF_SECONDS)
+
+async def learn_trigger(stats=None):
+    """
+    Returns why learning should run now, or None if it should not
+    """
+    stats = stats or await feedback_statistics()
+    if not stats["new_history"]:
+        return None
+
+    auto_learn = stats["auto_learn"]
+    if auto_learn:
+        job = await get_job(auto_learn["job_id"])
+        if job and job["status"] in ("queued", "running"):
+            return None
+        if time.time() - auto_learn["at"] < cooldown_seconds(consecutive_failures(auto_learn, job)):
+            return None
+
+    # A drop only counts once there is new feedback to learn from
+    if (stats["drop_z_score"] is not None and stats["drop_z_score"] >= DROP_Z_SCORE
+            and stats["new_history"] >= MIN_SAMPLES):
+        return f"feedback quality dropped (z={stats['drop_z_score']:.1f})"
+    if stats["new_history"] >= EVIDENCE_THRESHOLD:
+        return f"{stats['new_history']} new feedback entries"
+    return None
+
+async def record_auto_learn(job_id, reason):
+    """
+    Stores the trigger of an automatic learn job, the baseline for the next trigger's evidence
+    """
+    previous = await data.get("auto_learn")
+    failures = 0
+    if previous:
+        failures = consecutive_failures(previous, await get_job(previous["job_id"]))
+    await data.set("auto_learn", {
+        "job_id": job_id,
+        "reason": reason,
+        "at": time.time(),
+        "history_version": await data.get("history_version"),
+        "history_length": await data.list_length("history"),
+        "failures": failures,
+    })
@@ -0,0 +1,116 @@
+"""
+Opt-in request hedging for providers with long latency tails.
+
+When a call has not returned within a percentile of that provider's recent
+latencies, a duplicate request is sent. The first success wins and the other
+request is cancelled. The share of calls that may be hedged is capped. A
+primary that loses to its hedge is recorded with the time it had run when it
+was cancelled, a lower bound that keeps slow calls in the latency window.
+
+Hedging runs inside the provider's limiter (see singletons/limiter.py), so
+latencies only cover the provider request itself, not time spent waiting for
+rate limit capacity or retry backoff. A hedge request takes its own limiter
+capacity and is skipped when none is free right away, since a duplicate that
+queues behind the original cannot win and only spends scarce quota.
+
+Hedging is enabled per provider with TOGETHER_HEDGE=1 or DEEPGRAM_HEDGE=1, and
+tuned with HEDGE_PERCENTILE (default 95) and HEDGE_MAX_RATE (default 0.1).
+"""
+import asyncio
+import collections
+import os
+import time
+
+MIN_LATENCY_SAMPLES = 20  # No hedging until enough latencies are known
+
+class Hedger:
+    def __init__(self, name, enabled, percentile=95, max_rate=0.1, window=200):
+        self.name = name
+        self.enabled = enabled
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.latencies = collections.deque(maxlen=window)
+        self.stats = {
+            "calls": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "skipped_no_capacity": 0,
+        }
+
+    def hedge_delay(self):
+        """
+        Seconds to wait before hedging, or None if this call should not be hedged
+        """
+        if not self.enabled or len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        if self.stats["hedges"] >= self.max_rate * self.stats["calls"]:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    async def timed(self, func):
+        started = time.monotonic()
+        result = await func()
+        self.latencies.append(time.monotonic() - started)
+        return result
+
+    async def call(self, func, try_acquire):
+        """
+        Awaits func(), hedging it with a second func() call if it is slow.
+        func must create a fresh request every time it is called, and only
+        runs as a hedge when try_acquire() grants capacity for it.
+        """
+        self.stats["calls"] += 1
+        started = time.monotonic()
+        primary = asyncio.create_task(self.timed(func))
+        tasks = {primary}
+        try:
+            delay = self.hedge_delay()
+            if delay is None:
+                return await primary
+
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            hedged = not done
+            if hedged and not try_acquire():
+                self.stats["skipped_no_capacity"] += 1
+                return await primary
+            if hedged:
+                self.stats["hedges"] += 1
+                print(f"{self.name} call slower than {delay:.2f}s, sending hedge request")
+                tasks.add(asyncio.create_task(self.timed(func)))
+
+            # The first success wins; an error only counts once every request failed
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        if hedged:
+                            self.stats["primary_wins" if task is primary else "hedge_wins"] += 1
+                        if primary in tasks:
+                            # The slow primary is cancelled below without a sample of its own. Its time
+                            # so far is a lower bound, without it the window would drift to fast calls.
+                            self.latencies.append(time.monotonic() - started)
+                        return task.result()
+                    if not tasks:
+                        raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def metrics(self):
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "hedge_delay_seconds": self.hedge_delay() if self.enabled else None,
+            "latency_samples": len(self.latencies),
+        }
+
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", 0.1))
+
+hedgers = {
+    "together": Hedger("together", os.getenv("TOGETHER_HEDGE") == "1", HEDGE_PERCENTILE, HEDGE_MAX_RATE),
+    "deepgram": Hedger("deepgram", os.getenv("DEEPGRAM_HEDGE") == "1", HEDGE_PERCENTILE, HEDGE_MAX_RATE),
+}
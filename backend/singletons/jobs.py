@@ -0,0 +1,52 @@
+"""
+Learn jobs submitted through /ai/learn.
+
+Jobs are stored in the data singleton under "learn_job:<id>" so any worker can
+report on them, and have the following structure:
+{
+    "id": str,            # Job id returned when the job is submitted
+    "status": str,        # queued, running, succeeded, failed or cancelled
+    "created_at": str,    # ISO timestamp of submission
+    "started_at": str,    # ISO timestamp the worker picked the job up, or None
+    "finished_at": str,   # ISO timestamp the job ended, or None
+    "history_entries": int,  # Size of the history snapshot the job learns from
+    "iterations": [       # Appended as each learn iteration completes
+        {
+            "iteration": int,
+            "average_score": float,
+            "scores": [float],  # Score of every interaction in that iteration
+            "candidate_scores": [float],  # Average score of each candidate persona tried
+            "persona_version": int  # Version recorded if a candidate replaced the persona, see singletons/persona.py
+        }
+    ],
+    "final_score": float, # Average score that met the threshold, or None
+    "error": str,         # Failure or cancellation reason, or None
+    "message": str,       # Why a job succeeded without learning, or None
+    "abandon_after": int  # Seconds without status polls before the job is cancelled, or None
+}
+
+A cancellation request is stored under "learn_job_cancel:<id>" as the reason for
+it, which the worker running the job polls. The last time a job's status was
+polled is stored under "learn_job_seen:<id>".
+
+Each API worker queues the jobs submitted to it in process, so the queue bound is
+split between WORKERS (see singletons/state.py). Jobs still run one at a time
+across all workers: the worker running a job holds the "learn_lease" key, naming
+the job, and renews it every second until the job ends.
+"""
+from singletons.data import data
+from singletons.state import WORKERS
+
+MAX_QUEUED_JOBS = max(1, 4 // WORKERS)  # Submissions beyond this are rejected until this worker's queue drains
+LEARN_LEASE_KEY = "learn_lease"
+LEARN_LEASE_TTL = 30  # Seconds before the lease of a worker that died is taken over
+JOB_TTL = 24 * 60 * 60  # Seconds a finished job stays queryable
+
+def job_key(job_id):
+    return f"learn_job:{job_id}"
+
+async def get_job(job_id):
+    return await data.get(job_key(job_id))
+
+async def save_job(job, ttl=None):
+    await data.set(job_key(job["id"]), job, ttl=ttl)
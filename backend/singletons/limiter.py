@@ -0,0 +1,245 @@
+"""
+Client-side rate limiters shared by every route that calls an external provider.
+
+Each provider gets a token bucket for requests per minute and, where the provider
+meters them, one for tokens per minute. Calls made through a limiter wait for
+capacity, then retry retryable failures (429, 5xx, connection errors) with jittered
+exponential backoff, honouring Retry-After when the provider sends it.
+
+Limits are read from the environment, e.g. OPENAI_RPM and OPENAI_TPM. Buckets
+live in each API worker, so every worker gets 1/WORKERS of each limit (see
+singletons/state.py) and together they stay within the provider's quota. A call
+estimated at more tokens than a worker's whole minute of budget can never fit,
+so it fails with RequestTooLarge straight away instead of draining the bucket and
+holding up every caller queued behind it.
+"""
+import asyncio
+import email.utils
+import inspect
+import os
+import random
+import time
+
+import aiohttp
+import openai
+import requests
+
+from singletons.cancellation import cancelled_by_disconnect
+from singletons.hedge import hedgers
+from singletons.state import WORKERS
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_ERRORS = (
+    ConnectionError,
+    asyncio.TimeoutError,
+    aiohttp.ClientConnectionError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    openai.APIConnectionError,
+)
+
+class RequestTooLarge(Exception):
+    pass
+
+class TokenBucket:
+    """
+    Refills continuously up to capacity, spread evenly over a minute
+    """
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self.refill()
+        return max(0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self.tokens -= amount
+
+class ProviderLimiter:
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None, max_retries=4, hedger=None):
+        self.name = name
+        self.hedger = hedger  # Hedges slow provider requests, see singletons/hedge.py
+        # Each worker's share of the provider's limits
+        self.requests = TokenBucket(requests_per_minute / WORKERS)
+        self.tokens = TokenBucket(tokens_per_minute / WORKERS) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.blocked_until = 0  # Set from Retry-After so every caller backs off
+        self.lock = asyncio.Lock()  # Grants capacity to waiting callers in arrival order
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "too_large": 0,  # Calls rejected for needing more than a minute of tokens
+            "waiting": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            # Calls abandoned while queued or in flight, because the client disconnected or
+            # for any other reason, e.g. an abandoned learn job. Hedge requests that lose
+            # their race are cancelled inside the call and only show up in the hedger's stats.
+            "disconnect_cancelled": 0,
+            "disconnect_cancelled_tokens": 0,
+            "cancelled": 0,
+            "cancelled_tokens": 0,
+        }
+
+    async def acquire(self, tokens=0):
+        """
+        Waits until one request and the estimated tokens fit in the buckets
+        """
+        started = time.monotonic()
+        self.stats["waiting"] += 1
+        try:
+            async with self.lock:
+                while True:
+                    wait = max(self.blocked_until - time.monotonic(), self.requests.wait_time(1))
+                    if self.tokens and tokens:
+                        wait = max(wait, self.tokens.wait_time(tokens))
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                self.requests.take(1)
+                if self.tokens and tokens:
+                    self.tokens.take(tokens)
+        finally:
+            self.stats["waiting"] -= 1
+
+        waited = time.monotonic() - started
+        self.stats["requests"] += 1
+        self.stats["total_wait_seconds"] += waited
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    def try_acquire(self, tokens=0):
+        """
+        Takes one request and the estimated tokens only if they are free right now,
+        without overtaking callers already waiting
+        """
+        if self.lock.locked() or self.blocked_until > time.monotonic():
+            return False
+        if self.requests.wait_time(1) > 0 or (self.tokens and tokens and self.tokens.wait_time(tokens) > 0):
+            return False
+        self.requests.take(1)
+        if self.tokens and tokens:
+            self.tokens.take(tokens)
+        self.stats["requests"] += 1
+        return True
+
+    async def invoke(self, func, *args, **kwargs):
+        # SDK methods are often wrapped in decorators that hide the coroutine function
+        if inspect.iscoroutinefunction(inspect.unwrap(func)):
+            return await func(*args, **kwargs)
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def call(self, func, *args, tokens=0, **kwargs):
+        """
+        Calls func through the limiter, retrying retryable failures and hedging slow
+        requests if the limiter has a hedger. Blocking functions are run in a worker
+        thread, where cancelling the call cannot stop them.
+        """
+        if self.tokens and tokens > self.tokens.capacity:
+            self.stats["too_large"] += 1
+            raise RequestTooLarge(
+                f"{self.name} request estimated at {tokens} tokens exceeds the limit of {self.tokens.capacity} per minute"
+            )
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.acquire(tokens)
+                if self.hedger is not None:
+                    return await self.hedger.call(
+                        lambda: self.invoke(func, *args, **kwargs),
+                        lambda: self.try_acquire(tokens)
+                    )
+                return await self.invoke(func, *args, **kwargs)
+            except asyncio.CancelledError:
+                reason = "disconnect_cancelled" if cancelled_by_disconnect() else "cancelled"
+                self.stats[reason] += 1
+                self.stats[f"{reason}_tokens"] += tokens
+                raise
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self.stats["failures"] += 1
+                    raise
+
+                delay = retry_after_seconds(e)
+                if delay is not None:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+                    delay += random.uniform(0, 0.5)
+                else:
+                    delay = random.uniform(0, min(30, 2 ** attempt))
+
+                self.stats["retries"] += 1
+                print(f"{self.name} call failed ({str(e)[:100]}), retry {attempt + 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def metrics(self):
+        return {
+            **self.stats,
+            "average_wait_seconds": self.stats["total_wait_seconds"] / max(1, self.stats["requests"]),
+            "requests_per_minute": self.requests.capacity,
+            "tokens_per_minute": self.tokens.capacity if self.tokens else None,
+        }
+
+def status_code(error):
+    return getattr(error, "status_code", None) or getattr(error, "status", None)
+
+def is_retryable(error):
+    return isinstance(error, RETRYABLE_ERRORS) or status_code(error) in RETRYABLE_STATUS_CODES
+
+def retry_after_seconds(error):
+    """
+    Reads Retry-After (seconds or HTTP date) from the error or its response, if present
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None and getattr(error, "response", None) is not None:
+        headers = getattr(error.response, "headers", None)
+    value = headers.get("Retry-After") or headers.get("retry-after") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time()) if retry_at else None
+
+def estimate_openai_tokens(messages, max_tokens=None):
+    """
+    Rough token estimate for a chat request: ~4 characters per token, a flat cost per image
+    depending on its detail level
+    """
+    tokens = 0
+    for message in messages:
+        content = message["content"]
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 4
+            elif part["image_url"].get("detail") == "low":
+                tokens += 85
+            else:
+                tokens += 765  # A high detail 1024x768 image
+    return tokens + (max_tokens or 1000)
+
+async def openai_chat(client, **kwargs):
+    """
+    Creates a chat completion through the shared OpenAI limiter
+    """
+    tokens = estimate_openai_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+    return await limiters["openai"].call(client.chat.completions.create, tokens=tokens, **kwargs)
+
+limiters = {
+    "openai": ProviderLimiter(
+        "openai",
+        int(os.getenv("OPENAI_RPM", 500)),
+        int(os.getenv("OPENAI_TPM", 30000))
+    ),
+    "groq": ProviderLimiter("groq", int(os.getenv("GROQ_RPM", 20))),
+    "deepgram": ProviderLimiter("deepgram", int(os.getenv("DEEPGRAM_RPM", 100)), hedger=hedgers["deepgram"]),
+    "together": ProviderLimiter("together", int(os.getenv("TOGETHER_RPM", 6)), hedger=hedgers["together"]),
+}
@@ -0,0 +1,75 @@
+"""
+Memory reporting for in-process structures, served by /debug/memory.
+
+Modules holding sizeable state register a function reporting it with
+register_structure. Each report is a dict with at least "bytes", an estimate of
+the memory the structure holds.
+
+Setting MEMORY_TRACE_FRAMES above 0 starts tracemalloc with that many frames per
+allocation, so reports can list the top allocation sites and how they grew since
+the previous report. Tracing slows the process down and is off by default.
+"""
+import os
+import sys
+import threading
+import tracemalloc
+
+TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", 0))
+
+structures = {}  # name -> function returning a dict with at least "bytes"
+previous_snapshot = None  # Compared against by the next allocation report
+snapshot_lock = threading.Lock()
+
+if TRACE_FRAMES > 0:
+    tracemalloc.start(TRACE_FRAMES)
+
+def register_structure(name, report):
+    structures[name] = report
+
+def structure_sizes():
+    sizes = {}
+    for name, report in structures.items():
+        try:
+            sizes[name] = report()
+        except Exception as e:
+            sizes[name] = {"error": str(e)}
+    return sizes
+
+def peak_rss_bytes():
+    try:
+        import resource  # Not available on Windows
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports kilobytes
+
+def allocation_report(top=10):
+    """
+    Returns the top allocation sites and the sites that grew most since the last report,
+    or None if tracemalloc is not tracing. Blocking, run it in a thread.
+    """
+    global previous_snapshot
+    if not tracemalloc.is_tracing():
+        return None
+
+    with snapshot_lock:
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        growth = snapshot.compare_to(previous_snapshot, "lineno")[:top] if previous_snapshot else []
+        previous_snapshot = snapshot
+
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "traced_bytes": current,
+        "traced_peak_bytes": peak,
+        "top_allocations": [
+            {"site": str(stat.traceback[0]), "bytes": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:top]
+        ],
+        "growth_since_last_report": [
+            {"site": str(stat.traceback[0]), "bytes": stat.size, "bytes_diff": stat.size_diff, "count_diff": stat.count_diff}
+            for stat in growth
+        ],
+    }
@@ -0,0 +1,143 @@
+"""
+Per-stage OpenAI model routing with latency and cost telemetry.
+
+Every stage that calls a chat model is routed through this table, which picks
+the model, the max_tokens cap and the detail level of attached images:
+    answer               - /ai/call-multimodal answers the student reads
+    call_llm             - /ai/call-llm
+    persona_creation     - /ai/create-user-persona
+    evaluation           - scoring one interaction while learning
+    batch_evaluation     - scoring several interactions in one request, max_tokens is per interaction
+    persona_optimization - proposing persona edits while learning
+    search_queries       - /websearch query generation
+    search_answer        - /websearch answers
+
+Bulk stages default to a small model, student-facing ones to gpt-4o. Defaults
+can be overridden at startup with MODEL_ROUTES, a JSON object such as
+{"evaluation": {"model": "gpt-4o"}}, and at runtime through /debug/models.
+Runtime overrides live in the data singleton under "model_routes" so every
+worker applies them.
+"""
+import collections
+import json
+import os
+import time
+
+from singletons.data import data
+from singletons.limiter import openai_chat
+
+DEFAULT_ROUTES = {
+    "answer": {"model": "gpt-4o", "max_tokens": 300, "detail": "auto"},
+    "call_llm": {"model": "gpt-4o", "max_tokens": None, "detail": "auto"},
+    "persona_creation": {"model": "gpt-4o", "max_tokens": None, "detail": "auto"},
+    "evaluation": {"model": "gpt-4o-mini", "max_tokens": 300, "detail": "low"},
+    "batch_evaluation": {"model": "gpt-4o-mini", "max_tokens": 200, "detail": "low"},
+    "persona_optimization": {"model": "gpt-4o", "max_tokens": 1000, "detail": "auto"},  # Edits, not the whole persona
+    "search_queries": {"model": "gpt-4o-mini", "max_tokens": 300, "detail": "low"},
+    "search_answer": {"model": "gpt-4o", "max_tokens": None, "detail": "auto"},
+}
+STARTUP_ROUTES = json.loads(os.getenv("MODEL_ROUTES") or "{}")
+
+# USD per million (input, output) tokens, models missing here are reported without cost
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4": (30.00, 60.00),
+}
+
+def known_models():
+    """
+    Models a route may be switched to at runtime: the priced ones and any already routed at startup
+    """
+    routes = [*DEFAULT_ROUTES.values(), *STARTUP_ROUTES.values()]
+    return set(MODEL_PRICES) | {route["model"] for route in routes if route.get("model")}
+
+class StageTelemetry:
+    def __init__(self, window=200):
+        self.latencies = collections.deque(maxlen=window)
+        self.stats = {
+            "calls": 0,
+            "errors": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cost_usd": 0.0,
+            "unpriced_calls": 0,
+        }
+        self.models = collections.Counter()
+
+    def record(self, model, latency, usage):
+        self.stats["calls"] += 1
+        self.models[model] += 1
+        self.latencies.append(latency)
+        if usage is None:
+            return
+        self.stats["prompt_tokens"] += usage.prompt_tokens
+        self.stats["completion_tokens"] += usage.completion_tokens
+        price = MODEL_PRICES.get(model)
+        if price is None:
+            self.stats["unpriced_calls"] += 1
+        else:
+            self.stats["cost_usd"] += (usage.prompt_tokens * price[0] + usage.completion_tokens * price[1]) / 1e6
+
+    def metrics(self):
+        ordered = sorted(self.latencies)
+        def percentile(p):
+            return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else None
+        return {
+            **self.stats,
+            "models": dict(self.models),
+            "p50_latency": percentile(50),
+            "p95_latency": percentile(95),
+        }
+
+telemetry = {stage: StageTelemetry() for stage in DEFAULT_ROUTES}
+
+async def model_route(stage):
+    """
+    Returns the model, max_tokens and detail a stage currently uses
+    """
+    return {
+        **DEFAULT_ROUTES[stage],
+        **STARTUP_ROUTES.get(stage, {}),
+        **(await data.get("model_routes", {})).get(stage, {}),
+    }
+
+async def set_model_route(stage, overrides):
+    """
+    Replaces the runtime overrides of a stage, an empty dict restoring its startup route
+    """
+    while True:
+        current = await data.get("model_routes")
+        routes = dict(current or {})
+        if overrides:
+            routes[stage] = overrides
+        else:
+            routes.pop(stage, None)
+        if await data.compare_and_set("model_routes", current, routes):
+            return await model_route(stage)
+
+async def stage_chat(client, stage, messages, max_tokens_scale=1, **kwargs):
+    """
+    Creates a chat completion with the model, max_tokens and image detail routed to stage
+    """
+    route = await model_route(stage)
+    for message in messages:
+        if isinstance(message["content"], list):
+            for part in message["content"]:
+                if part["type"] == "image_url":
+                    part["image_url"].setdefault("detail", route["detail"])
+    if route["max_tokens"]:
+        kwargs["max_tokens"] = route["max_tokens"] * max_tokens_scale
+
+    started = time.monotonic()
+    try:
+        response = await openai_chat(client, model=route["model"], messages=messages, **kwargs)
+    except Exception:
+        telemetry[stage].stats["errors"] += 1
+        raise
+    telemetry[stage].record(route["model"], time.monotonic() - started, getattr(response, "usage", None))
+    return response
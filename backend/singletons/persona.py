@@ -0,0 +1,193 @@
+"""
+Structured persona edits and persona version history.
+
+Learning no longer asks the model to rewrite the whole persona. It returns a
+short list of edits instead, each naming a field of routes/persona_template.xml
+by its path below <Persona>, for example
+"CognitiveProfile/LearningStyles/PreferredFormat/SentenceLength":
+    {"op": "set", "path": ..., "value": ...}                       - replace the text of a field
+    {"op": "set_attribute", "path": ..., "attribute": ..., "value": ...}
+    {"op": "add_item", "path": ..., "value": ..., "attributes": {...}}
+    {"op": "remove_item", "path": ..., "value": ...}              - by Item text or name attribute
+Edits are checked against the template before any is applied, so a bad edit
+rejects the whole candidate rather than corrupting the persona.
+
+Every persona that becomes current is recorded in the "persona_history" list of
+the data singleton with an increasing version number, so rolling back is a
+single compare_and_set of a stored snapshot. Only the newest
+PERSONA_HISTORY_LIMIT versions are kept.
+"""
+import functools
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+
+from singletons.data import data
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "routes", "persona_template.xml")
+PERSONA_HISTORY_LIMIT = int(os.getenv("PERSONA_HISTORY_LIMIT", 20))
+MAX_EDITS = 20  # Edits accepted from one optimization, a learn round should only nudge the persona
+ATTRIBUTE_NAME = re.compile(r"^[A-Za-z_][\w.-]*$")
+BARE_AMPERSAND = re.compile(r"&(?!#?\w+;)")  # Models often write "Math & Science" unescaped
+
+class PersonaError(Exception):
+    pass
+
+def parse_persona(text):
+    """
+    Parses persona XML, ignoring anything the model wrapped around the <Persona> element
+    and escaping bare ampersands
+    """
+    start = text.find("<Persona")
+    end = text.rfind("</Persona>")
+    if start == -1 or end == -1:
+        raise PersonaError("No <Persona> element found")
+    try:
+        return ET.fromstring(BARE_AMPERSAND.sub("&amp;", text[start:end + len("</Persona>")]))
+    except ET.ParseError as e:
+        raise PersonaError(f"Persona is not valid XML: {e}")
+
+@functools.lru_cache(maxsize=1)
+def template_fields():
+    """
+    Returns {path: field} for every element of the persona template, where field
+    records whether it holds text, Item children and/or attributes
+    """
+    with open(TEMPLATE_PATH, "r") as f:
+        root = parse_persona(f.read())
+    fields = {}
+    def walk(element, path):
+        for child in element:
+            if child.tag == "Item":
+                continue
+            child_path = f"{path}/{child.tag}" if path else child.tag
+            children = [grandchild.tag for grandchild in child]
+            fields[child_path] = {
+                "text": not children and not child.attrib,
+                "items": "Item" in children,
+                "attributes": bool(child.attrib),
+            }
+            walk(child, child_path)
+    walk(root, "")
+    return fields
+
+def template_summary():
+    """
+    Lists the editable paths for the optimizer prompt, marking list and attribute fields
+    """
+    lines = []
+    for path, field in template_fields().items():
+        kinds = [kind for kind in ("text", "items", "attributes") if field[kind]]
+        if kinds:
+            lines.append(f"{path} ({', '.join(kinds)})")
+    return "\n".join(lines)
+
+def validate_edit(edit):
+    fields = template_fields()
+    if not isinstance(edit, dict):
+        raise PersonaError(f"Edit is not an object: {edit!r}")
+    op, path = edit.get("op"), edit.get("path")
+    field = fields.get(path)
+    if field is None:
+        raise PersonaError(f"Unknown persona field: {path!r}")
+    if not isinstance(edit.get("value"), str):
+        raise PersonaError(f"Edit of {path} has no string value")
+    if op == "set" and not field["text"]:
+        raise PersonaError(f"{path} has no text to set")
+    elif op == "set_attribute":
+        if not field["attributes"] or not ATTRIBUTE_NAME.match(str(edit.get("attribute", ""))):
+            raise PersonaError(f"Invalid attribute edit of {path}")
+    elif op in ("add_item", "remove_item"):
+        if not field["items"]:
+            raise PersonaError(f"{path} is not a list of items")
+        attributes = edit.get("attributes") or {}
+        if not isinstance(attributes, dict) or not all(ATTRIBUTE_NAME.match(str(name)) for name in attributes):
+            raise PersonaError(f"Invalid item attributes for {path}")
+    elif op != "set":
+        raise PersonaError(f"Unknown edit operation: {op!r}")
+
+def find_or_create(root, path):
+    element = root
+    for tag in path.split("/"):
+        child = element.find(tag)
+        if child is None:
+            child = ET.SubElement(element, tag)
+        element = child
+    return element
+
+def apply_edits(persona, edits):
+    """
+    Returns persona with edits applied, raising PersonaError if any edit does not fit the template
+    """
+    if not isinstance(edits, list) or len(edits) > MAX_EDITS:
+        raise PersonaError(f"Expected a list of at most {MAX_EDITS} edits")
+    for edit in edits:
+        validate_edit(edit)
+
+    root = parse_persona(persona)
+    for edit in edits:
+        element = find_or_create(root, edit["path"])
+        if edit["op"] == "set":
+            element.text = edit["value"]
+        elif edit["op"] == "set_attribute":
+            element.set(edit["attribute"], edit["value"])
+        elif edit["op"] == "add_item":
+            item = ET.SubElement(element, "Item", {
+                str(name): str(value) for name, value in (edit.get("attributes") or {}).items()
+            })
+            item.text = edit["value"]
+        else:
+            matches = [
+                item for item in element.findall("Item")
+                if (item.text or "").strip() == edit["value"].strip() or item.get("name") == edit["value"]
+            ]
+            if not matches:
+                raise PersonaError(f"No item {edit['value']!r} in {edit['path']}")
+            for item in matches:
+                element.remove(item)
+    ET.indent(root, space="    ")
+    return ET.tostring(root, encoding="unicode")
+
+async def persona_history():
+    return await data.get_list("persona_history")
+
+async def record_persona_version(persona, source, edits=None, score=None):
+    """
+    Appends persona to the version history and returns its version number
+    """
+    while True:
+        current = await data.get("persona_version")
+        version = (current or 0) + 1
+        if await data.compare_and_set("persona_version", current, version):
+            break
+    length = await data.append("persona_history", {
+        "version": version,
+        "persona": persona,
+        "source": source,
+        "edits": edits or [],
+        "score": score,
+        "created_at": time.time(),
+    })
+    if length > PERSONA_HISTORY_LIMIT:
+        await data.trim_list("persona_history", length - PERSONA_HISTORY_LIMIT)
+    return version
+
+async def persona_version(version):
+    for entry in await persona_history():
+        if entry["version"] == version:
+            return entry
+    return None
+
+async def rollback_persona(version):
+    """
+    Makes a stored version current again, recording the rollback as a new version.
+    Returns the new version number, or None if the persona changed while rolling back.
+    """
+    entry = await persona_version(version)
+    if entry is None:
+        raise PersonaError(f"Persona version {version} is not in the history")
+    current = await data.get("student_persona")
+    if not await data.compare_and_set("student_persona", current, entry["persona"]):
+        return None
+    return await record_persona_version(entry["persona"], f"rollback:{version}")
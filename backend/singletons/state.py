@@ -0,0 +1,514 @@
+"""
+Pluggable state stores, so application state can be shared by several API workers.
+
+STATE_BACKEND selects the store:
+    memory  - process-local dicts, the default for a single worker. Beyond
+              STATE_MEMORY_BUDGET bytes the least recently used keys spill to a
+              SQLite file at STATE_SPILL_PATH.
+    sqlite  - a SQLite database in WAL mode at STATE_SQLITE_PATH, shared by workers on one host
+    redis   - a Redis-protocol server at REDIS_URL, shared by workers on any host
+
+Every store holds JSON-serialisable values under string keys, plus lists that
+support atomic appends. compare_and_set only writes when the stored value still
+equals the expected one, so concurrent persona updates cannot overwrite each other.
+
+Stores are synchronous. Async code uses them through AsyncStore, which runs the
+calls of stores doing blocking I/O in a worker thread so a slow database or a
+SQLite lock held by another worker never stalls the event loop. SQLite waits at
+most STATE_SQLITE_BUSY_TIMEOUT seconds for such a lock.
+
+Only what is kept in the store is shared. Provider limiters, admission gates and
+the learn queue stay in each worker, so they split their limits by WORKERS, the
+number of API workers read from WEB_CONCURRENCY like uvicorn's --workers.
+"""
+import asyncio
+import collections
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+
+class StateStore:
+    blocking = True  # Whether calls do I/O that must not run on the event loop
+
+    def get(self, key, default=None):
+        """Returns the value stored under key, or default if it is missing or expired"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Stores value under key, expiring it after ttl seconds if given"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Removes the value or list stored under key"""
+        raise NotImplementedError
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        """
+        Stores value only if key currently holds expected (None meaning missing), expiring
+        it after ttl seconds if given. Returns True if written.
+        """
+        raise NotImplementedError
+
+    def append(self, key, item):
+        """Atomically appends item to the list under key and returns the new length"""
+        raise NotImplementedError
+
+    def get_list(self, key):
+        """Returns every item of the list under key, oldest first"""
+        raise NotImplementedError
+
+    def list_length(self, key):
+        """Returns the number of items in the list under key"""
+        raise NotImplementedError
+
+    def trim_list(self, key, count):
+        """Atomically removes the oldest count items from the list under key"""
+        raise NotImplementedError
+
+    def compare_and_trim(self, key, expected, value, list_key, count, ttl=None):
+        """
+        Like compare_and_set, also removing the oldest count items from the list under
+        list_key in the same atomic step. Returns True if written.
+        """
+        raise NotImplementedError
+
+    def metrics(self):
+        """Reports how much the store holds in process memory"""
+        return {"bytes": 0}
+
+class MemoryStore(StateStore):
+    """
+    Process-local store. Once the JSON-encoded size of its contents exceeds max_bytes,
+    the least recently used keys spill to a SQLite file at spill_path and are loaded
+    back into memory when next used.
+    """
+    blocking = False  # Spills go to a file only this process uses, so they never wait on a lock
+    def __init__(self, max_bytes=None, spill_path=None):
+        self.values = {}  # key -> (value, expires_at)
+        self.lists = {}
+        self.sizes = collections.OrderedDict()  # ("value" or "list", key) -> bytes, least recently used first
+        self.size = 0
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.spill = None  # SQLiteStore opened on the first spill
+        self.spilled = set()  # ("value" or "list", key) held by the spill store
+        self.spills = 0
+        self.loads = 0
+        self.lock = threading.Lock()
+
+    # The helpers below expect self.lock to be held
+
+    def use(self, slot):
+        if slot in self.spilled:
+            self.load(slot)
+            self.enforce_budget()
+        elif slot in self.sizes:
+            self.sizes.move_to_end(slot)
+
+    def account(self, slot, size):
+        self.size += size - self.sizes.get(slot, 0)
+        self.sizes[slot] = size
+        self.sizes.move_to_end(slot)
+
+    def forget(self, slot):
+        self.size -= self.sizes.pop(slot, 0)
+
+    def enforce_budget(self):
+        while self.max_bytes and self.size > self.max_bytes and len(self.sizes) > 1:
+            self.spill_slot(next(iter(self.sizes)))
+
+    def spill_slot(self, slot):
+        if self.spill is None:
+            self.spill = SQLiteStore(self.spill_path)
+        kind, key = slot
+        if kind == "value":
+            value, expires_at = self.values.pop(key)
+            if expires_at is None or expires_at > time.time():
+                self.spill.set(key, [value, expires_at], ttl=expires_at - time.time() if expires_at else None)
+                self.spilled.add(slot)
+        else:
+            self.spill.set("list:" + key, self.lists.pop(key))
+            self.spilled.add(slot)
+        self.forget(slot)
+        self.spills += 1
+
+    def load(self, slot):
+        kind, key = slot
+        self.spilled.discard(slot)
+        self.loads += 1
+        if kind == "value":
+            entry = self.spill.get(key)
+            self.spill.delete(key)
+            if entry is not None:
+                self.values[key] = (entry[0], entry[1])
+                self.account(slot, len(json.dumps(entry[0])))
+        else:
+            items = self.spill.get("list:" + key, [])
+            self.spill.delete("list:" + key)
+            self.lists[key] = items
+            self.account(slot, sum(len(json.dumps(item)) for item in items))
+
+    def get(self, key, default=None):
+        slot = ("value", key)
+        with self.lock:
+            self.use(slot)
+            value, expires_at = self.values.get(key, (default, None))
+            if expires_at is not None and expires_at <= time.time():
+                del self.values[key]
+                self.forget(slot)
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        slot = ("value", key)
+        with self.lock:
+            if slot in self.spilled:
+                self.spilled.discard(slot)
+                self.spill.delete(key)
+            self.values[key] = (value, time.time() + ttl if ttl else None)
+            self.account(slot, len(json.dumps(value)))
+            self.enforce_budget()
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+            self.lists.pop(key, None)
+            for slot in (("value", key), ("list", key)):
+                self.forget(slot)
+                self.spilled.discard(slot)
+            if self.spill is not None:
+                self.spill.delete(key)
+                self.spill.delete("list:" + key)
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        slot = ("value", key)
+        with self.lock:
+            self.use(slot)
+            current, expires_at = self.values.get(key, (None, None))
+            if expires_at is not None and expires_at <= time.time():
+                current = None
+            if current != expected:
+                return False
+            self.values[key] = (value, time.time() + ttl if ttl else None)
+            self.account(slot, len(json.dumps(value)))
+            self.enforce_budget()
+            return True
+
+    def append(self, key, item):
+        slot = ("list", key)
+        with self.lock:
+            self.use(slot)
+            items = self.lists.setdefault(key, [])
+            items.append(item)
+            self.account(slot, self.sizes.get(slot, 0) + len(json.dumps(item)))
+            self.enforce_budget()
+            return len(items)
+
+    def get_list(self, key):
+        with self.lock:
+            self.use(("list", key))
+            return list(self.lists.get(key, []))
+
+    def list_length(self, key):
+        with self.lock:
+            self.use(("list", key))
+            return len(self.lists.get(key, []))
+
+    def trim_list(self, key, count):
+        slot = ("list", key)
+        with self.lock:
+            self.use(slot)
+            items = self.lists.get(key, [])
+            removed = sum(len(json.dumps(item)) for item in items[:count])
+            del items[:count]
+            if slot in self.sizes:
+                self.account(slot, self.sizes[slot] - removed)
+
+    def compare_and_trim(self, key, expected, value, list_key, count, ttl=None):
+        # One lock covers both steps, so no snapshot can be taken between them
+        with self.lock:
+            slot = ("value", key)
+            self.use(slot)
+            current, expires_at = self.values.get(key, (None, None))
+            if expires_at is not None and expires_at <= time.time():
+                current = None
+            if current != expected:
+                return False
+            self.values[key] = (value, time.time() + ttl if ttl else None)
+            self.account(slot, len(json.dumps(value)))
+
+            list_slot = ("list", list_key)
+            self.use(list_slot)
+            items = self.lists.get(list_key, [])
+            removed = sum(len(json.dumps(item)) for item in items[:count])
+            del items[:count]
+            if list_slot in self.sizes:
+                self.account(list_slot, self.sizes[list_slot] - removed)
+            self.enforce_budget()
+            return True
+
+    def metrics(self):
+        with self.lock:
+            by_prefix = collections.Counter()
+            for (_, key), size in self.sizes.items():
+                by_prefix[key.split(":")[0]] += size
+            return {
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "keys_in_memory": len(self.sizes),
+                "keys_spilled": len(self.spilled),
+                "spills": self.spills,
+                "loads": self.loads,
+                "bytes_by_prefix": dict(by_prefix),
+            }
+
+class SQLiteStore(StateStore):
+    def __init__(self, path, busy_timeout=5):
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=busy_timeout)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS state_lists (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, value TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS state_lists_key ON state_lists (key, id)")
+
+    def execute(self, query, params=()):
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def get(self, key, default=None):
+        rows = self.execute(
+            "SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())
+        )
+        return json.loads(rows[0][0]) if rows else default
+
+    def set(self, key, value, ttl=None):
+        self.execute(
+            "INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl if ttl else None)
+        )
+        if ttl:
+            self.execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+
+    def delete(self, key):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("DELETE FROM state WHERE key = ?", (key,))
+            self.connection.execute("DELETE FROM state_lists WHERE key = ?", (key,))
+            self.connection.execute("COMMIT")
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                    (key, now)
+                ).fetchall()
+                current = json.loads(rows[0][0]) if rows else None
+                if current != expected:
+                    return False
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), now + ttl if ttl else None)
+                )
+                return True
+            finally:
+                self.connection.execute("COMMIT")
+
+    def append(self, key, item):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "INSERT INTO state_lists (key, value) VALUES (?, ?)", (key, json.dumps(item))
+                )
+                return self.connection.execute(
+                    "SELECT COUNT(*) FROM state_lists WHERE key = ?", (key,)
+                ).fetchone()[0]
+            finally:
+                self.connection.execute("COMMIT")
+
+    def get_list(self, key):
+        rows = self.execute("SELECT value FROM state_lists WHERE key = ? ORDER BY id", (key,))
+        return [json.loads(row[0]) for row in rows]
+
+    def list_length(self, key):
+        return self.execute("SELECT COUNT(*) FROM state_lists WHERE key = ?", (key,))[0][0]
+
+    def trim_list(self, key, count):
+        self.execute(
+            "DELETE FROM state_lists WHERE id IN (SELECT id FROM state_lists WHERE key = ? ORDER BY id LIMIT ?)",
+            (key, count)
+        )
+
+    def compare_and_trim(self, key, expected, value, list_key, count, ttl=None):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                    (key, now)
+                ).fetchall()
+                current = json.loads(rows[0][0]) if rows else None
+                if current != expected:
+                    return False
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), now + ttl if ttl else None)
+                )
+                self.connection.execute(
+                    "DELETE FROM state_lists WHERE id IN (SELECT id FROM state_lists WHERE key = ? ORDER BY id LIMIT ?)",
+                    (list_key, count)
+                )
+                return True
+            finally:
+                self.connection.execute("COMMIT")
+
+class RedisStore(StateStore):
+    # Compares the JSON encoding, an empty string standing for a missing key or no TTL
+    COMPARE_AND_SET = """
+    local current = redis.call('GET', KEYS[1])
+    if (current == false and ARGV[1] == '') or current == ARGV[1] then
+        if ARGV[3] == '' then
+            redis.call('SET', KEYS[1], ARGV[2])
+        else
+            redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+        end
+        return 1
+    end
+    return 0
+    """
+    COMPARE_AND_TRIM = """
+    local current = redis.call('GET', KEYS[1])
+    if (current == false and ARGV[1] == '') or current == ARGV[1] then
+        if ARGV[4] == '' then
+            redis.call('SET', KEYS[1], ARGV[2])
+        else
+            redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[4])
+        end
+        redis.call('LTRIM', KEYS[2], tonumber(ARGV[3]), -1)
+        return 1
+    end
+    return 0
+    """
+
+    def __init__(self, url, prefix="adapt-learner:"):
+        import redis  # Only needed for this backend
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.compare_and_set_script = self.client.register_script(self.COMPARE_AND_SET)
+        self.compare_and_trim_script = self.client.register_script(self.COMPARE_AND_TRIM)
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else default
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=expiry(ttl))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key, self.prefix + "list:" + key)
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        encoded_expected = json.dumps(expected) if expected is not None else ""
+        return bool(self.compare_and_set_script(
+            keys=[self.prefix + key], args=[encoded_expected, json.dumps(value), expiry(ttl) or ""]
+        ))
+
+    def append(self, key, item):
+        return self.client.rpush(self.prefix + "list:" + key, json.dumps(item))
+
+    def get_list(self, key):
+        return [json.loads(item) for item in self.client.lrange(self.prefix + "list:" + key, 0, -1)]
+
+    def list_length(self, key):
+        return self.client.llen(self.prefix + "list:" + key)
+
+    def trim_list(self, key, count):
+        self.client.ltrim(self.prefix + "list:" + key, count, -1)
+
+    def compare_and_trim(self, key, expected, value, list_key, count, ttl=None):
+        encoded_expected = json.dumps(expected) if expected is not None else ""
+        return bool(self.compare_and_trim_script(
+            keys=[self.prefix + key, self.prefix + "list:" + list_key],
+            args=[encoded_expected, json.dumps(value), count, expiry(ttl) or ""]
+        ))
+
+def expiry(ttl):
+    # Redis expiries are whole seconds
+    return max(1, int(ttl)) if ttl else None
+
+class AsyncStore:
+    """
+    Awaitable view of a store, running blocking stores in a worker thread.
+    Code that already runs in a thread uses the wrapped store as .sync.
+    """
+    def __init__(self, store):
+        self.sync = store
+
+    async def run(self, method, *args, **kwargs):
+        if self.sync.blocking:
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return method(*args, **kwargs)
+
+    async def get(self, key, default=None):
+        return await self.run(self.sync.get, key, default)
+
+    async def set(self, key, value, ttl=None):
+        return await self.run(self.sync.set, key, value, ttl=ttl)
+
+    async def delete(self, key):
+        return await self.run(self.sync.delete, key)
+
+    async def compare_and_set(self, key, expected, value, ttl=None):
+        return await self.run(self.sync.compare_and_set, key, expected, value, ttl=ttl)
+
+    async def append(self, key, item):
+        return await self.run(self.sync.append, key, item)
+
+    async def get_list(self, key):
+        return await self.run(self.sync.get_list, key)
+
+    async def list_length(self, key):
+        return await self.run(self.sync.list_length, key)
+
+    async def trim_list(self, key, count):
+        return await self.run(self.sync.trim_list, key, count)
+
+    async def compare_and_trim(self, key, expected, value, list_key, count, ttl=None):
+        return await self.run(self.sync.compare_and_trim, key, expected, value, list_key, count, ttl=ttl)
+
+    def metrics(self):
+        return self.sync.metrics()
+
+def create_store():
+    backend = os.getenv("STATE_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryStore(
+            max_bytes=int(os.getenv("STATE_MEMORY_BUDGET", 256 * 1024 * 1024)),
+            spill_path=os.getenv("STATE_SPILL_PATH") or os.path.join(
+                tempfile.gettempdir(), f"adapt-learner-spill-{os.getpid()}.db"
+            )
+        )
+    if backend == "sqlite":
+        return SQLiteStore(
+            os.getenv("STATE_SQLITE_PATH", "app.db"),
+            busy_timeout=float(os.getenv("STATE_SQLITE_BUSY_TIMEOUT", 5))
+        )
+    if backend == "redis":
+        return RedisStore(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
@@ -0,0 +1,56 @@
+"""
+Multipart upload parsing shared by the endpoints that accept raw files.
+
+Uploaded files are kept in memory up to UPLOAD_SPOOL_THRESHOLD bytes and spill
+to a temp file beyond that, so large media never has to be held in memory or
+base64-encoded by the client. Bodies over an endpoint's size limit are rejected
+with a 413 while they are being received.
+"""
+import os
+
+from fastapi import HTTPException
+from starlette.datastructures import UploadFile
+from starlette.formparsers import FormParser, MultiPartParser
+
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", 1024 * 1024))  # Bytes kept in memory per upload
+
+class SpooledUploadParser(MultiPartParser):
+    # Uploaded files stay in memory up to this size, then spill to a temp file on disk
+    spool_max_size = UPLOAD_SPOOL_THRESHOLD
+
+async def limited_stream(request, max_size):
+    """
+    Yields the request body chunk by chunk, rejecting it once it exceeds max_size
+    """
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_size:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {max_size} bytes")
+        yield chunk
+
+async def parse_upload_form(request, max_size, max_files=1):
+    """
+    Parses a multipart form of at most max_size bytes. Close the returned form when done with it.
+    Forms without files may also be sent urlencoded.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and int(content_length) > max_size:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {max_size} bytes")
+
+    if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+        return await FormParser(request.headers, limited_stream(request, max_size)).parse()
+    return await SpooledUploadParser(
+        request.headers,
+        limited_stream(request, max_size),
+        max_files=max_files
+    ).parse()
+
+def form_file(form, field="file"):
+    """
+    Returns the uploaded file in a form field, raising a 400 if it is missing
+    """
+    upload = form.get(field)
+    if not isinstance(upload, UploadFile):
+        raise HTTPException(status_code=400, detail=f"File upload failed: missing {field} field")
+    return upload
@@ -0,0 +1,171 @@
+"""
+Vector store namespaces for /websearch, so each search only looks at content
+scraped for its own session or document.
+
+Every namespace is its own Chroma collection. Namespaces idle for longer than
+VECTOR_NAMESPACE_TTL seconds are dropped, each one keeps at most
+VECTOR_NAMESPACE_BYTES of chunks (its oldest chunks are evicted first), and
+whole namespaces are evicted least recently used first once there are more
+than VECTOR_MAX_NAMESPACES or all of them exceed VECTOR_MEMORY_BUDGET. Sizes
+are estimated from the chunk text and the embedding vector.
+
+Collections live in memory unless VECTOR_PERSIST_DIR is set, in which case they
+are stored there and namespaces found on disk are adopted at startup.
+
+Adding, querying and dropping embed text and may create, write or delete
+collections on disk, so async code runs them in a thread. One lock keeps the
+namespace bookkeeping and the Chroma calls behind it consistent across threads.
+"""
+import collections
+import hashlib
+import os
+import threading
+import time
+
+import chromadb
+from chromadb.config import Settings
+
+from singletons.memory import register_structure
+
+VECTOR_MEMORY_BUDGET = int(os.getenv("VECTOR_MEMORY_BUDGET", 64 * 1024 * 1024))  # All namespaces together
+VECTOR_NAMESPACE_BYTES = int(os.getenv("VECTOR_NAMESPACE_BYTES", 8 * 1024 * 1024))
+VECTOR_NAMESPACE_TTL = int(os.getenv("VECTOR_NAMESPACE_TTL", 60 * 60))
+VECTOR_MAX_NAMESPACES = int(os.getenv("VECTOR_MAX_NAMESPACES", 64))
+VECTOR_PERSIST_DIR = os.getenv("VECTOR_PERSIST_DIR")
+EMBEDDING_BYTES = 384 * 4  # float32 vector of Chroma's default embedding model
+
+def chunk_bytes(chunk):
+    return len(chunk.encode()) + EMBEDDING_BYTES
+
+def collection_name(namespace):
+    # Chroma only accepts short alphanumeric names, so namespaces are hashed
+    return "ns-" + hashlib.sha256(namespace.encode()).hexdigest()[:32]
+
+class Namespace:
+    def __init__(self, name, collection):
+        self.name = name
+        self.collection = collection
+        self.chunks = collections.OrderedDict()  # chunk id -> estimated bytes, oldest first
+        self.bytes = 0
+        self.last_used = time.monotonic()
+
+class VectorNamespaces:
+    def __init__(self, persist_dir=None):
+        if persist_dir:
+            self.client = chromadb.PersistentClient(path=persist_dir)
+        else:
+            self.client = chromadb.Client(Settings(is_persistent=False))
+        self.namespaces = collections.OrderedDict()  # name -> Namespace, least recently used first
+        self.lock = threading.RLock()
+        self.stats = {
+            "expired_namespaces": 0,
+            "evicted_namespaces": 0,
+            "evicted_chunks": 0,
+        }
+        if persist_dir:
+            self.restore()
+
+    def restore(self):
+        """Adopts the namespaces persisted by a previous run, their idle time starting now"""
+        for collection in self.client.list_collections():
+            if isinstance(collection, str):  # Newer Chroma versions only list names
+                collection = self.client.get_collection(collection)
+            name = (collection.metadata or {}).get("namespace")
+            if name is None:
+                continue
+            namespace = Namespace(name, collection)
+            stored = collection.get(include=["documents"])
+            for chunk_id, chunk in zip(stored["ids"], stored["documents"]):
+                namespace.chunks[chunk_id] = chunk_bytes(chunk or "")
+            namespace.bytes = sum(namespace.chunks.values())
+            self.namespaces[name] = namespace
+        print(f"Restored {len(self.namespaces)} vector namespaces from disk")
+        self.evict()
+
+    def get(self, name):
+        """Returns the namespace called name, creating it if needed, and marks it as used"""
+        with self.lock:
+            self.expire()
+            namespace = self.namespaces.get(name)
+            if namespace is None:
+                collection = self.client.get_or_create_collection(
+                    name=collection_name(name),
+                    metadata={"namespace": name}
+                )
+                namespace = Namespace(name, collection)
+                self.namespaces[name] = namespace
+            self.namespaces.move_to_end(name)
+            namespace.last_used = time.monotonic()
+            return namespace
+
+    def add(self, name, ids, documents, metadatas):
+        """Upserts chunks into a namespace, then evicts whatever no longer fits. Blocking, run it in a thread."""
+        with self.lock:
+            namespace = self.get(name)
+            namespace.collection.upsert(ids=ids, documents=documents, metadatas=metadatas)
+            for chunk_id, chunk in zip(ids, documents):
+                namespace.bytes += chunk_bytes(chunk) - namespace.chunks.pop(chunk_id, 0)
+                namespace.chunks[chunk_id] = chunk_bytes(chunk)
+
+            evicted = []
+            while namespace.bytes > VECTOR_NAMESPACE_BYTES and len(namespace.chunks) > 1:
+                chunk_id, size = namespace.chunks.popitem(last=False)
+                namespace.bytes -= size
+                evicted.append(chunk_id)
+            if evicted:
+                namespace.collection.delete(ids=evicted)
+                self.stats["evicted_chunks"] += len(evicted)
+            self.evict(keep=name)
+
+    def query(self, name, text, n_results):
+        """
+        Returns the documents and metadatas of the chunks in a namespace most similar to text.
+        Blocking, run it in a thread.
+        """
+        with self.lock:
+            namespace = self.get(name)
+            if not namespace.chunks:
+                return [], []
+            results = namespace.collection.query(query_texts=[text], n_results=min(n_results, len(namespace.chunks)))
+            return results["documents"][0], results["metadatas"][0]
+
+    def drop(self, name):
+        """Deletes a namespace and its collection. Blocking, run it in a thread."""
+        with self.lock:
+            namespace = self.namespaces.pop(name, None)
+            if namespace is not None:
+                self.client.delete_collection(namespace.collection.name)
+
+    def expire(self):
+        cutoff = time.monotonic() - VECTOR_NAMESPACE_TTL
+        for name in [name for name, namespace in self.namespaces.items() if namespace.last_used < cutoff]:
+            self.drop(name)
+            self.stats["expired_namespaces"] += 1
+
+    def evict(self, keep=None):
+        """Drops least recently used namespaces, other than keep, until the limits are met"""
+        while len(self.namespaces) > VECTOR_MAX_NAMESPACES or self.total_bytes() > VECTOR_MEMORY_BUDGET:
+            victim = next((name for name in self.namespaces if name != keep), None)
+            if victim is None:
+                break
+            self.drop(victim)
+            self.stats["evicted_namespaces"] += 1
+
+    def total_bytes(self):
+        return sum(namespace.bytes for namespace in self.namespaces.values())
+
+    def metrics(self):
+        with self.lock:
+            return {
+                **self.stats,
+                "namespaces": len(self.namespaces),
+                "chunks": sum(len(namespace.chunks) for namespace in self.namespaces.values()),
+                "bytes": self.total_bytes(),
+                "max_bytes": VECTOR_MEMORY_BUDGET,
+                "max_namespace_bytes": VECTOR_NAMESPACE_BYTES,
+                "max_namespaces": VECTOR_MAX_NAMESPACES,
+                "persistent": bool(VECTOR_PERSIST_DIR),
+            }
+
+vector_namespaces = VectorNamespaces(VECTOR_PERSIST_DIR)
+register_structure("vector_namespaces", vector_namespaces.metrics)
@@ -0,0 +1,34 @@
+"""
+Feedback polarity, the wording signal automatic learning watches for drops.
+Run with `python -m pytest test` from backend/.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from singletons.feedback_stats import feedback_polarity
+
+@pytest.mark.parametrize("feedback, polarity", [
+    ("great, thanks", 1.0),
+    ("confusing and too long", -1.0),
+    ("no", 0.0),
+    # A negator flips the cue that follows it
+    ("I didn't understand this", -1.0),
+    ("it is not helpful", -1.0),
+    ("I don’t like it", -1.0),
+    ("It was not very clear", -1.0),
+    ("not bad", 1.0),
+    ("nothing was clear", -1.0),
+    # A trailing "nothing" flips the cue before it
+    ("I understood nothing", -1.0),
+    # Negation stops at the end of its clause
+    ("not bad, really helpful", 1.0),
+    ("didn't help, boring", -1.0),
+    ("clear. nothing else", 1.0),
+    ("great but not clear", 0.0),
+])
+def test_feedback_polarity(feedback, polarity):
+    assert feedback_polarity(feedback) == polarity
@@ -0,0 +1,120 @@
+"""
+Semantics every state store backend must share: compare_and_set, atomic list
+appends and trims, TTLs and deletes. Run with `python -m pytest test` from backend/.
+Redis is tested against fakeredis when it is installed.
+"""
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from singletons.state import AsyncStore, MemoryStore, RedisStore, SQLiteStore
+
+@pytest.fixture(params=["memory", "memory_spilling", "sqlite", "redis"])
+def store(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        return MemoryStore()
+    if request.param == "memory_spilling":
+        # A tiny budget spills everything but the most recently used key
+        return MemoryStore(max_bytes=1, spill_path=str(tmp_path / "spill.db"))
+    if request.param == "sqlite":
+        return SQLiteStore(str(tmp_path / "state.db"))
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.Redis, "from_url",
+        lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs)
+    )
+    return RedisStore("redis://test")
+
+def test_get_set_and_delete(store):
+    assert store.get("missing") is None
+    assert store.get("missing", "default") == "default"
+    store.set("key", {"a": [1, 2]})
+    store.set("other", "value")
+    assert store.get("key") == {"a": [1, 2]}
+    store.delete("key")
+    assert store.get("key") is None
+    assert store.get("other") == "value"
+
+def test_ttl_expires(store):
+    store.set("short", 1, ttl=1)
+    store.set("long", 2, ttl=60)
+    assert store.get("short") == 1
+    time.sleep(1.1)
+    assert store.get("short") is None
+    assert store.get("long") == 2
+
+def test_compare_and_set(store):
+    # None expects the key to be missing
+    assert store.compare_and_set("key", None, 1)
+    assert not store.compare_and_set("key", None, 2)
+    assert not store.compare_and_set("key", 5, 2)
+    assert store.get("key") == 1
+    assert store.compare_and_set("key", 1, {"b": 2})
+    assert store.compare_and_set("key", {"b": 2}, "c")
+    assert store.get("key") == "c"
+
+def test_compare_and_set_ttl(store):
+    assert store.compare_and_set("short", None, 1, ttl=1)
+    assert store.compare_and_set("long", None, 1, ttl=1)
+    # Without a ttl the written value does not expire
+    assert store.compare_and_set("long", 1, 2)
+    time.sleep(1.1)
+    assert store.get("short") is None
+    assert store.get("long") == 2
+
+def test_lists(store):
+    assert store.get_list("list") == []
+    assert store.list_length("list") == 0
+    for i in range(5):
+        assert store.append("list", {"i": i}) == i + 1
+    assert store.get_list("list") == [{"i": i} for i in range(5)]
+    store.trim_list("list", 2)
+    assert store.get_list("list") == [{"i": i} for i in range(2, 5)]
+    assert store.list_length("list") == 3
+    store.trim_list("list", 10)
+    assert store.get_list("list") == []
+    assert store.append("list", "again") == 1
+
+def test_compare_and_trim(store):
+    for i in range(4):
+        store.append("history", i)
+    assert store.compare_and_trim("version", None, 1, "history", 2)
+    assert store.get("version") == 1
+    assert store.get_list("history") == [2, 3]
+    # A stale version neither bumps the version nor trims
+    assert not store.compare_and_trim("version", None, 1, "history", 2)
+    assert store.get_list("history") == [2, 3]
+    assert store.compare_and_trim("version", 1, 2, "history", 5, ttl=1)
+    assert store.get_list("history") == []
+    time.sleep(1.1)
+    assert store.get("version") is None
+
+def test_lists_and_values_are_separate(store):
+    store.set("key", "value")
+    store.append("key", "item")
+    assert store.get("key") == "value"
+    assert store.get_list("key") == ["item"]
+    store.delete("key")
+    assert store.get("key") is None
+    assert store.get_list("key") == []
+
+def test_async_store(store):
+    async def run():
+        data = AsyncStore(store)
+        await data.set("key", 1)
+        assert await data.compare_and_set("key", 1, 2)
+        assert await data.append("list", "a") == 1
+        assert await data.get_list("list") == ["a"]
+        await data.trim_list("list", 1)
+        assert await data.compare_and_trim("version", None, 1, "list", 1)
+        assert await data.list_length("list") == 0
+        await data.delete("key")
+        return await data.get("key", "gone")
+    assert asyncio.run(run()) == "gone"
@@ -58,19 +58,6 @@ export function RecordingPage({ type }: { type: string }) {
 
       try {
         setIsProcessing(true);
-        setProcessMessage('Converting audio file...');
-        console.log('Converting audio file to base64...');
-
-        const base64String = await new Promise<string>((resolve) => {
-          const reader = new FileReader();
-          reader.onloadend = () => {
-            const base64 = reader.result as string;
-            resolve(base64.split(',')[1]); // Remove data URL prefix
-          };
-          reader.readAsDataURL(file);
-        });
-
-        console.log('Base64 conversion successful.');
         setProcessMessage('Processing audio...');
         console.log('Sending audio to API endpoint...');
 
@@ -83,15 +70,14 @@ export function RecordingPage({ type }: { type: string }) {
         })();
         
         
-        const response = await fetch('http://localhost:8000/ai/set-initial-data', {
+        // Send the raw file instead of base64 JSON
+        const formData = new FormData();
+        formData.append('role', apiRole);
+        formData.append('file', file);
+
+        const response = await fetch('http://localhost:8000/ai/set-initial-data/upload', {
           method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-          body: JSON.stringify({
-            role: apiRole,
-            audio: base64String,
-          }),
+          body: formData,
         });
 
         if (!response.ok) {
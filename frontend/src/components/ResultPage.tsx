@@ -12,6 +12,7 @@ export function ResultPage() {
   const [uploadedFile, setUploadedFile] = useState<string | null>(null);
   const [queryText, setQueryText] = useState('');
   const [llmOutput, setLlmOutput] = useState('');
+  const [interactionId, setInteractionId] = useState<string | null>(null);
   const [audioData, setAudioData] = useState<string | null>(null);
   const [pdfViewportSize, setPdfViewportSize] = useState({ width: 800, height: 600 });
   const [isSelecting, setIsSelecting] = useState(false);
@@ -156,15 +157,14 @@ export function ResultPage() {
 
     if (screenshotData) {
       try {
-        const response = await fetch('http://localhost:8000/ai/call-multimodal', {
+        // Send the screenshot as a binary file instead of base64 JSON
+        const formData = new FormData();
+        formData.append('prompt', queryText);
+        formData.append('file', await (await fetch(screenshotData)).blob(), 'screenshot.jpg');
+
+        const response = await fetch('http://localhost:8000/ai/call-multimodal/upload', {
           method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-          body: JSON.stringify({
-            prompt: queryText,
-            image_base64: screenshotData
-          }),
+          body: formData,
         });
 
         if (!response.ok) {
@@ -173,6 +173,7 @@ export function ResultPage() {
 
         const data = await response.json();
         setLlmOutput(data.response);
+        setInteractionId(data.interaction_id);
         setAudioData(data.audio_base64);
         console.log('API Response:', data.response);
       } catch (error) {
@@ -192,16 +193,13 @@ export function ResultPage() {
 
   const handleFeedbackSubmit = async () => {
     try {
-      console.log("Screenshot Data : ",screenshotData)
       const response = await fetch('http://localhost:8000/ai/feedback', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
         body: JSON.stringify({
-          request: queryText,
-          material: screenshotData,
-          output: llmOutput,
+          interaction_id: interactionId,
           feedback: feedback
         }),
       });
@@ -233,9 +231,25 @@ export function ResultPage() {
         throw new Error('Learning process failed');
       }
 
-      const data = await response.json();
-      if (data.status === 'success') {
-        alert(`Learning completed successfully! Final score: ${data.final_score}`);
+      const { job_id } = await response.json();
+
+      // Learning runs as a background job, poll until it finishes
+      let job;
+      do {
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+        const statusResponse = await fetch(`http://localhost:8000/ai/learn/${job_id}`);
+        if (!statusResponse.ok) {
+          throw new Error('Failed to get learning status');
+        }
+        job = await statusResponse.json();
+      } while (job.status === 'queued' || job.status === 'running');
+
+      if (job.status === 'succeeded' && job.message) {
+        alert(job.message);
+      } else if (job.status === 'succeeded') {
+        alert(`Learning completed successfully! Final score: ${job.final_score}`);
+      } else {
+        throw new Error(job.error || 'Learning process failed');
       }
     } catch (error) {
       console.error('Error during learning process:', error);
@@ -281,6 +295,7 @@ export function ResultPage() {
           onQueryChange={setQueryText}
           onSubmit={handleSubmit}
           llmOutput={llmOutput}
+          interactionId={interactionId}
           isLoading={isLoading}
           audioBase64={audioData}
           feedback={feedback}
@@ -7,6 +7,7 @@ interface UploadQueryPanelProps {
   onQueryChange: (text: string) => void;
   onSubmit: () => void;
   llmOutput?: string;
+  interactionId?: string | null;
   isLoading?: boolean;
   audioBase64?: string | null;
 }
@@ -16,6 +17,7 @@ export const UploadQueryPanel: React.FC<UploadQueryPanelProps> = ({
   onQueryChange,
   onSubmit,
   llmOutput = '',
+  interactionId = null,
   isLoading = false,
   audioBase64,
 }) => {
@@ -61,9 +63,7 @@ export const UploadQueryPanel: React.FC<UploadQueryPanelProps> = ({
           'Content-Type': 'application/json',
         },
         body: JSON.stringify({
-          request: queryText,
-          material: '',
-          output: llmOutput,
+          interaction_id: interactionId,
           feedback: feedback,
         }),
       });